@@ -1,31 +1,103 @@
 import asyncio
 import logging
 import os
-import pytz
+import tempfile
+from collections import OrderedDict
+from urllib.parse import urlsplit
 from aiogram import Bot, Dispatcher, types, Router
-from aiogram.filters import Command
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject, StateFilter
+from aiogram.types import (
+    ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, FSInputFile
+)
 from dotenv import load_dotenv
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from datetime import datetime
-from aiogram.utils.markdown import hbold
-from database import Database
+import catalog_io
+import monitoring
+import workers
+from admins import AdminCache
+from callbacks import (
+    CallbackRouter, CatalogPage, ProductDetails, ViewProduct, AddToCart, CartIncrease, CartDecrease,
+    CartRemove, Checkout, AddFavorite, RemoveFavorite, DeleteProduct, OrderStatus, Noop, SearchPage,
+    OrdersPage, OrderDetails, GalleryPage
+)
+from database import AsyncDatabase, OutOfStockError, search_terms
+from fsm_storage import SQLiteStorage
+from sender import SendScheduler, bulk, create_session
+from validation import parse_discount_price, parse_price, parse_quantity
+from webhook import default_secret, run_webhook
+from render import (
+    RenderCache, PRODUCT_RENDERERS, order_status_label, render_catalog_page, render_favorites, render_gallery_page,
+    render_import_report, render_order_details, render_order_message, render_orders_page, render_search_results,
+    render_special_offers
+)
+from orders import INITIAL_STATUS
 
 # Загрузка переменных окружения
 load_dotenv()
 TOKEN = os.getenv("TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 GROUP_ID = int(os.getenv("GROUP_ID"))
+# Режим вебхука: если WEBHOOK_URL задан, обновления принимает встроенный HTTP-сервер вместо long polling.
+# WEBHOOK_REGISTER=0 не вызывает setWebhook (локальная проверка POST-запросами)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "64"))
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "1") != "0"
+# Число процессов-обработчиков; больше 1 - обновления раскладываются по процессам по id пользователя
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Порт эндпоинта /metrics на 127.0.0.1 (у обработчиков - следующие порты); 0 отключает его
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
 
 
 # Инициализация бота
-bot = Bot(token=TOKEN)
-dp = Dispatcher()
+sender = SendScheduler()
+bot = Bot(token=TOKEN, session=create_session())
+bot.session.middleware(sender)
+bot.session.middleware(monitoring.ApiTimer())
+admins = AdminCache(bot, GROUP_ID, ADMIN_ID)
+db = AsyncDatabase()
+# Состояния FSM хранятся в той же базе и переживают перезапуск бота
+dp = Dispatcher(storage=SQLiteStorage(db))
 router = Router()
-db = Database()
+callbacks = CallbackRouter()
+cards = RenderCache()
+metrics = monitoring.Metrics()
+metrics.add_gauges("send", sender.stats)
+metrics.add_gauges("product_cache", db.db.cache_stats)
+metrics.add_gauges("db_pool", db.db.pool_stats)
+metrics.add_gauges("render_cache", cards.stats)
 router = Router()
 
+# Количество товаров на одной странице каталога
+CATALOG_PAGE_SIZE = 5
+
+# Заказов на одной странице истории
+ORDERS_PAGE_SIZE = 5
+
+# Товаров на одной странице галереи - столько фото Telegram принимает в одной медиагруппе
+GALLERY_PAGE_SIZE = 10
+
+# Как часто удалять истекшие резервы товаров из корзин, секунд
+RESERVATION_SWEEP_INTERVAL = 60
+
+# Как часто процесс-обработчик сверяет кэш каталога с правками соседей, секунд
+CATALOG_SYNC_INTERVAL = 1.0
+
+# Больше Bot API не отдает боту через getFile
+MAX_IMPORT_BYTES = 20 * 1024 * 1024
+
+# Результатов поиска на странице и длина запроса, которая помещается в callback_data
+SEARCH_PAGE_SIZE = 5
+SEARCH_QUERY_BYTES = 40
+
+# Отпечатки последних отправленных корзин: (chat_id, message_id) -> (хэш текста, хэш клавиатуры)
+CART_MESSAGES_LIMIT = 10000
+cart_messages = OrderedDict()
+
 # Класс состояний для удаления товара
 class DeleteProductState(StatesGroup):
     waiting_product_choice = State()
@@ -43,6 +115,10 @@ class AddProduct(StatesGroup):
     quantity = State()
     image = State()
 
+# Класс состояний для импорта каталога из файла
+class ImportProducts(StatesGroup):
+    document = State()
+
 # Главное меню
 main_menu = ReplyKeyboardMarkup(
     keyboard=[
@@ -73,18 +149,6 @@ personal_account_kb = ReplyKeyboardMarkup(
 )
 
 
-# Панель администратора для изменения статуса заказа
-def admin_panel(order_id):
-    """Создает клавиатуру для изменения статуса заказа"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📦 В обработке", callback_data=f"status_{order_id}_processing")],
-        [InlineKeyboardButton(text="✅ Подтвержден", callback_data=f"status_{order_id}_confirmed")],
-        [InlineKeyboardButton(text="🚚 В пути", callback_data=f"status_{order_id}_shipped")],
-        [InlineKeyboardButton(text="🛑 Отменен", callback_data=f"status_{order_id}_canceled")],
-        [InlineKeyboardButton(text="🎉 Завершен", callback_data=f"status_{order_id}_completed")]
-    ])
-
-
 # Клавиатура подтверждения оферты
 offer_keyboard = ReplyKeyboardMarkup(
     keyboard=[
@@ -113,7 +177,7 @@ async def start_command(message: types.Message):
 # Команда добавления товара (только для администратора)
 @dp.message(Command("add_product"))
 async def add_product(message: types.Message, state: FSMContext):
-    if message.from_user.id != int(os.getenv("ADMIN_ID")):
+    if not admins.is_owner(message.from_user.id):
         await message.answer("❌ У вас нет прав для добавления товаров.")
         return
     
@@ -135,56 +199,61 @@ async def process_description(message: types.Message, state: FSMContext):
 @dp.message(AddProduct.price)
 async def process_price(message: types.Message, state: FSMContext):
     try:
-        price = float(message.text)
-        if price <= 0:
-            raise ValueError
-        await state.update_data(price=price)
-        await message.answer("Введите скидочную цену товара (в рублях):")
-        await state.set_state(AddProduct.discount_price)
-    except ValueError:
-        await message.answer("❌ Цена должна быть положительным числом. Попробуйте снова.")
+        price = parse_price(message.text)
+    except ValueError as error:
+        await message.answer(f"❌ {error} Попробуйте снова.")
+        return
+    await state.update_data(price=price)
+    await message.answer("Введите скидочную цену товара (в рублях):")
+    await state.set_state(AddProduct.discount_price)
 
 @dp.message(AddProduct.discount_price)
 async def process_discount_price(message: types.Message, state: FSMContext):
+    data = await state.get_data()
     try:
-        discount_price = float(message.text)
-        data = await state.get_data()
-        price = data["price"]
-
-        if discount_price >= price:
-            await message.answer("❌ Скидочная цена должна быть меньше основной. Введите снова:")
-            return
-
-        await state.update_data(discount_price=discount_price)
-        await message.answer("Введите количество товара на складе:")
-        await state.set_state(AddProduct.quantity)
-    except ValueError:
-        await message.answer("❌ Скидочная цена должна быть числом. Попробуйте снова.")
+        discount_price = parse_discount_price(message.text, data["price"])
+    except ValueError as error:
+        await message.answer(f"❌ {error} Попробуйте снова.")
+        return
+    await state.update_data(discount_price=discount_price)
+    await message.answer("Введите количество товара на складе:")
+    await state.set_state(AddProduct.quantity)
 
 @dp.message(AddProduct.quantity)
 async def process_quantity(message: types.Message, state: FSMContext):
     try:
-        quantity = int(message.text)
-        if quantity < 1:
-            raise ValueError
-        await state.update_data(quantity=quantity)
-        await message.answer("Введите ссылку на изображение товара (или отправьте 'без изображения'):")
-        await state.set_state(AddProduct.image)
-    except ValueError:
-        await message.answer("❌ Количество должно быть целым положительным числом.")
+        quantity = parse_quantity(message.text)
+    except ValueError as error:
+        await message.answer(f"❌ {error} Попробуйте снова.")
+        return
+    await state.update_data(quantity=quantity)
+    await message.answer(
+        "Отправьте фото товара или ссылку на изображение (или отправьте 'без изображения'):"
+    )
+    await state.set_state(AddProduct.image)
 
 @dp.message(AddProduct.image)
 async def process_image(message: types.Message, state: FSMContext):
-    image = message.text if message.text.lower() != 'без изображения' else None
+    image, image_file_id = None, None
+    if message.photo:
+        # Фото уже загружено в Telegram: ссылка не нужна, хватит file_id самого большого размера
+        image_file_id = message.photo[-1].file_id
+    elif message.text:
+        if message.text.lower() != 'без изображения':
+            image = message.text
+    else:
+        await message.answer("❌ Отправьте фото, ссылку или 'без изображения'.")
+        return
     data = await state.get_data()
 
-    db.add_product(
+    await db.add_product(
         name=data["name"],
         description=data["description"],
         price=data["price"],
         discount_price=data["discount_price"],
         quantity=data["quantity"],
-        image=image
+        image=image,
+        image_file_id=image_file_id
     )
 
     discount_percent = round((1 - data["discount_price"] / data["price"]) * 100, 2)
@@ -197,14 +266,73 @@ async def process_image(message: types.Message, state: FSMContext):
     await state.clear()
 
 
+# Импорт каталога из файла CSV или JSON (только для администратора)
+@dp.message(Command("import_products"))
+async def import_products(message: types.Message, state: FSMContext):
+    if not admins.is_owner(message.from_user.id):
+        await message.answer("❌ У вас нет прав для импорта товаров.")
+        return
+
+    await message.answer(
+        "Отправьте файл .csv или .json с колонками: "
+        f"{', '.join(catalog_io.FIELDS)}.\n"
+        "Товары с уже существующим названием будут обновлены, пустая скидочная цена - без скидки."
+    )
+    await state.set_state(ImportProducts.document)
+
+@dp.message(ImportProducts.document)
+async def process_import(message: types.Message, state: FSMContext):
+    document = message.document
+    fmt = catalog_io.detect_format(document.file_name) if document else None
+    if fmt is None:
+        await message.answer("❌ Нужен документ .csv или .json. Попробуйте снова.")
+        return
+    if document.file_size and document.file_size > MAX_IMPORT_BYTES:
+        await message.answer("❌ Файл больше 20 МБ - разделите его на части.")
+        return
+    await state.clear()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "import")
+        await bot.download(document, destination=path)
+        # Разбор и запись идут в потоке: event loop не ждет загрузки тысяч строк
+        report = await asyncio.to_thread(catalog_io.import_file, db.db, path, fmt)
+
+    logging.info("Импорт каталога", extra={
+        "inserted": report.inserted, "updated": report.updated, "rejected": report.rejected
+    })
+    await message.answer(render_import_report(report))
+
+
+# Выгрузка каталога в файл: /export_products [csv|json]
+@dp.message(Command("export_products"))
+async def export_products(message: types.Message, command: CommandObject):
+    if not admins.is_owner(message.from_user.id):
+        await message.answer("❌ У вас нет прав для выгрузки товаров.")
+        return
+
+    fmt = (command.args or "csv").strip().lower()
+    if fmt not in ("csv", "json"):
+        await message.answer("Использование: /export_products csv или /export_products json")
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, f"products.{fmt}")
+        count = await asyncio.to_thread(catalog_io.export_file, db.db, path, fmt)
+        if not count:
+            await message.answer("📭 Каталог пуст.")
+            return
+        await message.answer_document(FSInputFile(path), caption=f"📦 Товаров: {count}")
+
+
 # Команда для удаления товаров (доступно только админу)
 @dp.message(Command("delete_product"))
 async def delete_product(message: types.Message, admin_id=None):
-    if admin_id is None and message.from_user.id != int(os.getenv("ADMIN_ID")):
+    if admin_id is None and not admins.is_owner(message.from_user.id):
         await message.answer("У вас нет прав для удаления товаров ❌")
         return
 
-    products = db.get_product()
+    products = await db.get_product()
     
     if not products:
         await message.answer("📭 Каталог пуст, нечего удалять.")
@@ -212,7 +340,7 @@ async def delete_product(message: types.Message, admin_id=None):
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text=f"🗑 {name} - {price}₽", callback_data=f"delete_product_{product_id}")]
+            [InlineKeyboardButton(text=f"🗑 {name} - {price}₽", callback_data=DeleteProduct(product_id=product_id).pack())]
             for product_id, name, price, discount_price in products
         ]
     )
@@ -222,21 +350,17 @@ async def delete_product(message: types.Message, admin_id=None):
 
 
 # Обработчик удаления товара
-@dp.callback_query(lambda c: c.data.startswith("delete_product_"))
-async def process_delete_product(callback: types.CallbackQuery):
+@callbacks.handler(DeleteProduct)
+async def process_delete_product(callback: types.CallbackQuery, callback_data: DeleteProduct):
     admin_id = callback.from_user.id
-    try:
-        product_id = int(callback.data.split("_")[2])
-    except ValueError:
-        await callback.answer("⚠ Ошибка: некорректный идентификатор товара!", show_alert=True)
-        return
+    product_id = callback_data.product_id
 
-    product = db.get_product_by_id(product_id)
+    product = await db.get_product_by_id(product_id)
     if not product:
         await callback.answer("❌ Товар не найден.", show_alert=True)
         return
 
-    db.delete_product(product_id)
+    await db.delete_product(product_id)
     await callback.answer(f"✅ Товар «{product[1]}» удален!", show_alert=True)
     await callback.message.delete()
 
@@ -246,251 +370,313 @@ async def process_delete_product(callback: types.CallbackQuery):
 # Обработчик кнопки "🛍 Каталог"
 @router.message(lambda message: message.text == "🛍 Каталог")
 async def show_catalog(message: types.Message):
-    products = db.get_product()
+    page = await catalog_page()
 
-    if not products:
+    if page is None:
         await message.answer("❌ Товары пока не добавлены.")
         return
 
-    for product in products:
-        if len(product) == 4:  
-            product_id, name, price, discount_price = product
-        else:  
-            product_id, name, price = product
-            discount_price = price  
-
-        if discount_price < price:
-            discount_percent = round((1 - discount_price / price) * 100, 2)
-            price_text = (
-                f"🔥 <b>АКЦИЯ!</b> 🔥\n"
-                f"🎯 Старая цена: <s>{price}₽</s>\n"
-                f"💥 Новая цена: <b>{discount_price}₽</b>\n"
-                f"🎉 Вы экономите <b>-{discount_percent}%</b>!"
-            )
-        else:
-            price_text = f"💰 Цена: <b>{price}₽</b>"
-
-        buttons = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [InlineKeyboardButton(text="🛒 Купить", callback_data=f"add_to_cart_{product_id}")],
-                [InlineKeyboardButton(text="ℹ️ Подробнее", callback_data=f"details_{product_id}")],
-                [InlineKeyboardButton(text="❤️ Добавить в избранное", callback_data=f"add_favorite_{product_id}")]
-            ]
-        )
+    await message.answer(page.text, reply_markup=page.markup, parse_mode="HTML")
 
-        await message.answer(
-            f"{hbold(name)}\n💰 Цена: {price_text}", 
-            reply_markup=buttons, 
-            parse_mode="HTML"
-        )
 
+# Листание каталога: сообщение редактируется на месте
+@callbacks.handler(CatalogPage)
+async def paginate_catalog(callback: types.CallbackQuery, callback_data: CatalogPage):
+    page = await catalog_page(callback_data.cursor, backward=callback_data.backward)
 
-# Обработчик кнопки "ℹ️ Подробнее"
-@router.callback_query(lambda c: c.data.startswith("details_"))
-async def product_details(callback: types.CallbackQuery):
-    product_id = int(callback.data.split("_")[1])
-    product = db.get_product_details(product_id)
-    
-    if not product:
-        await callback.answer("❌ Товар не найден.", show_alert=True)
+    if page is None:
+        await callback.answer("❌ Товаров больше нет.", show_alert=True)
         return
-    
-    # Обрабатываем случай, если image может отсутствовать
-    if len(product) == 4:
-        name, description, price, discount_price = product
-        image = None
-    else:
-        name, description, price, discount_price, image = product
 
-    # Проверяем, что discount_price является числом
+    await edit_page(callback, page)
+
+
+async def edit_page(callback: types.CallbackQuery, card):
+    """Показывает страницу card на месте сообщения и отвечает на нажатие"""
     try:
-        discount_price = float(discount_price)
-    except ValueError:
-        discount_price = None  # Если это не число, устанавливаем значение None
+        await callback.message.edit_text(card.text, reply_markup=card.markup, parse_mode="HTML")
+    except TelegramBadRequest as error:
+        # Повторное нажатие той же кнопки: страница уже показана
+        if "message is not modified" not in error.message:
+            raise
+    await callback.answer()
 
-    # Преобразуем цену в float
-    price = float(price)
 
-    text = f"📌 {hbold(name)}\n\n📄 {description}\n\n"
+async def catalog_page(cursor=0, backward=False):
+    """Возвращает готовую страницу каталога из кэша рендеринга, при промахе собирает ее"""
+    version = db.catalog_version
+    key = (cursor, backward)
+    page = cards.get(key, "catalog", version)
+    if page is None:
+        products, has_prev, has_next = await db.get_catalog_page(cursor, CATALOG_PAGE_SIZE, backward)
+        if not products:
+            return None
+        page = cards.put(key, "catalog", version, render_catalog_page(products, has_prev, has_next))
+    return page
 
-    if discount_price is not None and discount_price < price:
-        discount_percent = round((1 - discount_price / price) * 100, 2)
-        text += f"🔥 <s>{price}₽</s> ➝ {discount_price}₽ (-{discount_percent}%)\n"
-    else:
-        text += f"💰 {price}₽\n"
 
-    if image and image.startswith("http"):
-        await callback.message.answer_photo(photo=image, caption=text, parse_mode="HTML")
-    else:
-        await callback.message.answer(text, parse_mode="HTML")
+# Галерея: фото товаров одной медиагруппой и одно сообщение с кнопками вместо карточки на товар
+@callbacks.handler(GalleryPage)
+async def gallery_page(callback: types.CallbackQuery, callback_data: GalleryPage):
+    products, has_next = await db.get_gallery_page(callback_data.cursor, GALLERY_PAGE_SIZE)
+
+    if not products:
+        await callback.answer("❌ Товаров с фото больше нет.", show_alert=True)
+        return
+
+    # Фото по ссылкам Telegram загружает несколько секунд - кнопку отпускаем сразу
+    await callback.answer()
+    items, keyboard = render_gallery_page(products, has_next)
+    await answer_media_group(callback.message, items)
+    await callback.message.answer(keyboard.text, parse_mode="HTML", reply_markup=keyboard.markup)
+
+
+async def answer_media_group(message, items):
+    """Отправляет пары (product_id, Card) одной медиагруппой и запоминает file_id фото, ушедших по ссылке"""
+    if len(items) == 1:
+        # Медиагруппа - от 2 фото
+        await answer_product_card(message, *items[0])
+        return
+
+    media = [InputMediaPhoto(media=card.image, caption=card.text, parse_mode="HTML") for _, card in items]
+    try:
+        sent = await message.answer_media_group(media)
+    except TelegramBadRequest as error:
+        # Одно непринятое фото отклоняет всю группу: отправляем по одному, там file_id восстанавливаются
+        logging.warning("Медиагруппа не отправлена", extra={"error": str(error)})
+        for product_id, card in items:
+            await answer_product_card(message, product_id, card)
+        return
+
+    captured = [
+        (product_id, sent_message.photo[-1].file_id, card.image_url)
+        for (product_id, card), sent_message in zip(items, sent)
+        if card.image == card.image_url and sent_message.photo
+    ]
+    if captured:
+        for product_id in await db.save_image_file_ids(captured):
+            cards.discard(product_id)
+
+
+async def product_card(product_id, kind):
+    """Возвращает готовую карточку товара из кэша рендеринга, при промахе собирает ее"""
+    version = db.catalog_version
+    card = cards.get(product_id, kind, version)
+    if card is None:
+        product = await db.get_product_details(product_id)
+        if not product:
+            return None
+        card = cards.put(product_id, kind, version, PRODUCT_RENDERERS[kind](product_id, product))
+    return card
+
+
+async def answer_product_card(message, product_id, card):
+    """Отправляет карточку товара.
+
+    Фото отправляется по file_id, сохраненному при первой отправке по ссылке: Telegram
+    не скачивает изображение заново. Если file_id не принят, фото отправляется по
+    ссылке и file_id запоминается снова; если не удалось и это - карточка уходит без фото."""
+    if card.image:
+        try:
+            sent = await message.answer_photo(
+                photo=card.image, caption=card.text, parse_mode="HTML", reply_markup=card.markup
+            )
+        except TelegramBadRequest as error:
+            logging.warning("Фото товара не отправлено", extra={"product_id": product_id, "error": str(error)})
+            # Фото, загруженное админом, ссылки не имеет - его file_id сбрасывать нельзя
+            if card.image_url and card.image != card.image_url:
+                await db.forget_image_file_id(product_id, card.image)
+                cards.discard(product_id)
+                return await answer_product_card(message, product_id, card._replace(image=card.image_url))
+        else:
+            if card.image == card.image_url and sent.photo:
+                if await db.save_image_file_id(product_id, sent.photo[-1].file_id, card.image_url):
+                    cards.discard(product_id)
+            return
+    await message.answer(card.text, parse_mode="HTML", reply_markup=card.markup)
+
+
+# Обработчик кнопки "ℹ️ Подробнее"
+@callbacks.handler(ProductDetails)
+async def product_details(callback: types.CallbackQuery, callback_data: ProductDetails):
+    product_id = callback_data.product_id
+    card = await product_card(product_id, "details")
+
+    if not card:
+        await callback.answer("❌ Товар не найден.", show_alert=True)
+        return
 
+    await answer_product_card(callback.message, product_id, card)
     await callback.answer()
 
 
 # Доюавление товара в избранное
-@router.callback_query(lambda c: c.data.startswith('add_favorite_'))
-async def add_to_favorite_callback(callback_query: types.CallbackQuery):
+@callbacks.handler(AddFavorite)
+async def add_to_favorite_callback(callback_query: types.CallbackQuery, callback_data: AddFavorite):
     user_id = callback_query.from_user.id
-    product_id = int(callback_query.data.split('_')[-1])
-    
-    db.add_to_favorites(user_id, product_id)
+    product_id = callback_data.product_id
+
+    if not await db.add_to_favorites(user_id, product_id):
+        # Кнопка осталась на старой странице, а товар уже удален
+        await callback_query.answer("❌ Товар не найден.", show_alert=True)
+        return
 
     await callback_query.answer("Товар добавлен в избранное! ❤️")
 
 
 # Добавление товара в корзину
-@dp.callback_query(lambda c: c.data.startswith("add_to_cart_"))
-async def add_to_cart(callback: types.CallbackQuery):
+@callbacks.handler(AddToCart)
+async def add_to_cart(callback: types.CallbackQuery, callback_data: AddToCart):
     user_id = callback.from_user.id
-    product_id = int(callback.data.split("_")[3])
-    quantity = 1  
+    product_id = callback_data.product_id
+    quantity = 1
 
-    
-    if db.add_to_cart(user_id, product_id, quantity):
-        await callback.answer("✅ Товар добавлен в корзину!")
+    in_cart = await db.add_to_cart(user_id, product_id, quantity)
+    if in_cart:
+        await callback.answer(f"✅ Товар добавлен в корзину! В корзине: {in_cart} шт.")
     else:
-        await callback.answer("❌ Ошибка при добавлении товара в корзину.", show_alert=True)
+        await callback.answer("❌ Товара не хватает: остаток закончился или зарезервирован в других корзинах.", show_alert=True)
 
 
 # Показ корзины
 @dp.message(lambda message: message.text == "🛒 Корзина")
-async def show_cart(message: types.Message, update=False):
+async def show_cart(message: types.Message):
     user_id = message.from_user.id
-    cart_items = db.show_cart(user_id)
+    cart_items = await db.show_cart(user_id)
 
-    print(f"🛒 Корзина для пользователя {user_id}: {cart_items}") 
+    logging.debug("Корзина пользователя", extra={"user_id": user_id, "items": len(cart_items)})
 
-    
+    if not cart_items:
+        await message.answer("🛒 Ваша корзина пуста.")
+        return
+
+    text, markup = render_cart(cart_items)
+    sent = await message.answer(text, parse_mode="Markdown", reply_markup=markup)
+    remember_cart_message(sent.chat.id, sent.message_id, text, markup)
+
+
+def render_cart(cart_items):
+    """Собирает текст и клавиатуру корзины"""
     text = "🛍 *Ваша корзина:*\n\n"
     total_price = 0
     inline_kb = []
 
-    for item in cart_items:
-        try:
-            product_id, name, discount_price, quantity = item
-        except ValueError as e:
-            print(f"❌ Ошибка распаковки данных корзины: {e}, item = {item}")
-            continue
-        
-        total_price += discount_price  * quantity
-        text += f"{name} - {discount_price }₽ (x{quantity})\n"
+    for product_id, name, discount_price, quantity in cart_items:
+        total_price += discount_price * quantity
+        text += f"{name} - {discount_price}₽ (x{quantity})\n"
         inline_kb.append([
-            InlineKeyboardButton(text="➖", callback_data=f"decrease_{product_id}"),
-            InlineKeyboardButton(text=f"{quantity}", callback_data="ignore"),
-            InlineKeyboardButton(text="➕", callback_data=f"increase_{product_id}"),
-            InlineKeyboardButton(text="❌ Удалить", callback_data=f"rremove_{product_id}")
+            InlineKeyboardButton(text="➖", callback_data=CartDecrease(product_id=product_id).pack()),
+            InlineKeyboardButton(text=f"{quantity}", callback_data=Noop().pack()),
+            InlineKeyboardButton(text="➕", callback_data=CartIncrease(product_id=product_id).pack()),
+            InlineKeyboardButton(text="❌ Удалить", callback_data=CartRemove(product_id=product_id).pack())
         ])
 
     text += f"\n💰 *Итого:* {total_price}₽"
-    inline_kb.append([InlineKeyboardButton(text="✅ Оформить заказ", callback_data="checkout")])
+    inline_kb.append([InlineKeyboardButton(text="✅ Оформить заказ", callback_data=Checkout().pack())])
 
-    markup = InlineKeyboardMarkup(inline_keyboard=inline_kb)
+    return text, InlineKeyboardMarkup(inline_keyboard=inline_kb)
 
-    if update:
-        await message.answer(text, parse_mode="Markdown", reply_markup=markup)
-    else:
-        await message.answer(text, parse_mode="Markdown", reply_markup=markup)
+
+def remember_cart_message(chat_id, message_id, text, markup):
+    """Запоминает отпечаток отправленной корзины, чтобы не редактировать ее без изменений"""
+    cart_messages[(chat_id, message_id)] = (hash(text), hash(markup.model_dump_json()))
+    cart_messages.move_to_end((chat_id, message_id))
+    while len(cart_messages) > CART_MESSAGES_LIMIT:
+        cart_messages.popitem(last=False)
+
+
+async def refresh_cart(callback: types.CallbackQuery):
+    """Перерисовывает сообщение корзины на месте. Возвращает False, если корзина опустела"""
+    message = callback.message
+    cart_items = await db.show_cart(callback.from_user.id)
+    key = (message.chat.id, message.message_id)
 
     if not cart_items:
-        await message.answer("🛒 Ваша корзина пуста.")
-        return
+        cart_messages.pop(key, None)
+        await message.delete()
+        return False
+
+    text, markup = render_cart(cart_items)
+    text_hash, markup_hash = hash(text), hash(markup.model_dump_json())
+    previous = cart_messages.get(key)
+
+    try:
+        if previous is None or previous[0] != text_hash:
+            await message.edit_text(text, parse_mode="Markdown", reply_markup=markup)
+        elif previous[1] != markup_hash:
+            await message.edit_reply_markup(reply_markup=markup)
+    except TelegramBadRequest as error:
+        # После перезапуска отпечатков нет, и Telegram сам сообщает, что менять нечего
+        if "message is not modified" not in error.message:
+            raise
+
+    remember_cart_message(message.chat.id, message.message_id, text, markup)
+    return True
 
 
 # Увеличение количества товара в корзине
-@dp.callback_query(lambda c: c.data.startswith("increase_"))
-async def increase_quantity(callback: types.CallbackQuery):
+@callbacks.handler(CartIncrease)
+async def increase_quantity(callback: types.CallbackQuery, callback_data: CartIncrease):
     user_id = callback.from_user.id
-    product_id = int(callback.data.split("_")[1])
+    product_id = callback_data.product_id
 
-    if db.increase_cart_item(user_id, product_id): 
+    # Если количество не выросло, корзина не изменилась и перерисовывать ее незачем
+    if await db.increase_cart_item(user_id, product_id):
         await callback.answer("➕ Количество товара увеличено!")
+        await refresh_cart(callback)
     else:
         await callback.answer("❌ Недостаточно товара на складе!", show_alert=True)
 
-    cart_items = db.show_cart(user_id)
-    if cart_items:
-        await show_cart(callback.message, update=True)  
-    else:
-        await callback.message.delete() 
-
 
 # Уменьшение количества товара в корзине
-@dp.callback_query(lambda c: c.data.startswith("decrease_"))
-async def decrease_quantity(callback: types.CallbackQuery):
+@callbacks.handler(CartDecrease)
+async def decrease_quantity(callback: types.CallbackQuery, callback_data: CartDecrease):
     user_id = callback.from_user.id
-    product_id = int(callback.data.split("_")[1])
+    product_id = callback_data.product_id
 
-    db.decrease_cart_item(user_id, product_id)
+    await db.decrease_cart_item(user_id, product_id)
 
-    cart_items = db.show_cart(user_id)
-    if cart_items:
+    if await refresh_cart(callback):
         await callback.answer("➖ Количество товара уменьшено!")
-        await show_cart(callback.message, update=True) 
     else:
-        await callback.message.delete()  
         await callback.answer("🛒 Ваша корзина пуста.")
 
 
 # Удаление товара из корзины
-@dp.callback_query(lambda c: c.data.startswith("rremove_"))
-async def remove_item(callback: types.CallbackQuery):
+@callbacks.handler(CartRemove)
+async def remove_item(callback: types.CallbackQuery, callback_data: CartRemove):
     user_id = callback.from_user.id
-    data_parts = callback.data.split("_")
-
-    if len(data_parts) < 2 or not data_parts[1].isdigit():
-        await callback.answer("⚠ Ошибка: некорректный запрос!", show_alert=True)
-        return
-
-    product_id = int(data_parts[1])
+    product_id = callback_data.product_id
 
-    db.remove_from_cart(user_id, product_id)
+    await db.remove_from_cart(user_id, product_id)
 
-    cart_items = db.show_cart(user_id)
-    if cart_items:
+    if await refresh_cart(callback):
         await callback.answer("❌ Товар удален из корзины!")
-        await show_cart(callback.message, update=True)
     else:
-        await callback.message.delete()
         await callback.answer("🛒 Ваша корзина пуста.")
 
 
 # Специальные предложения
 @dp.message(lambda message: message.text == "🔥 Специальные предложения")
 async def special_offers(message: types.Message):
-    products = db.get_products_sorted_by_discount() 
+    version = db.catalog_version
+    offers = cards.get(0, "offers", version)
 
-    if not products:
-        await message.answer("❌ Нет товаров со скидкой.")
-        return
+    if offers is None:
+        products = await db.get_products_sorted_by_discount()
 
-    text = "🔥 <b>Специальные предложения:</b>\n\n"
-    buttons = []
-
-    for product in products:
-        product_id, name, price, discount_price, image = product
-        discount_percent = round((1 - discount_price / price) * 100, 2) if discount_price < price else 0
+        if not products:
+            await message.answer("❌ Нет товаров со скидкой.")
+            return
 
-        text += f"🛍️ <b>{name}</b>\n"
-        if discount_percent > 0:
-            text += f"💰 <s>{price}₽</s> → <b>{discount_price}₽</b> (-{discount_percent}%)\n\n"
-        else:
-            text += f"💰 {price}₽\n\n"
+        offers = cards.put(0, "offers", version, render_special_offers(products))
 
-        buttons.append([
-            InlineKeyboardButton(text=f"🔍 {name}", callback_data=f"view_product_{product_id}"),
-            InlineKeyboardButton(text="🛒 В корзину", callback_data=f"add_to_cart_{product_id}")
-        ])
-
-    if buttons:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
-    else:
-        await message.answer("❌ Нет товаров со скидкой.")
+    await message.answer(offers.text, parse_mode="HTML", reply_markup=offers.markup)
 
 
 # Оферта перед заказом
-@dp.callback_query(lambda c: c.data == "checkout")
-async def send_offer(callback: types.CallbackQuery):
+@callbacks.handler(Checkout)
+async def send_offer(callback: types.CallbackQuery, callback_data: Checkout):
     offer_text = (
         "⚖️ Оферта для оформления заказа ⚖️\n\n"
         "Перед тем как подтвердить ваш заказ, пожалуйста, внимательно ознакомьтесь с нашими условиями.\n\n"
@@ -510,7 +696,7 @@ async def send_offer(callback: types.CallbackQuery):
 # Запрос номера телефона перед оформлением заказа
 @dp.message(lambda message: message.text == "✅ Подтвердить заказ")
 async def request_phone(message: types.Message, state: FSMContext):
-    cart_items = db.show_cart(message.from_user.id)  
+    cart_items = await db.show_cart(message.from_user.id)  
 
     if not cart_items:
         await message.answer("❌ Ваша корзина пуста.", reply_markup=main_menu)
@@ -531,93 +717,92 @@ async def checkout(message: types.Message, state: FSMContext):
 
     user_id = message.from_user.id
     phone_number = message.contact.phone_number  
-    cart_items = db.show_cart(user_id)  
 
-    if not cart_items:
-        await message.answer("❌ Ваша корзина пуста.", reply_markup=main_menu)
+    try:
+        order = await db.place_order(user_id, phone_number, message.from_user.full_name)
+    except OutOfStockError as error:
+        await message.answer(
+            f"❌ Недостаточно товара на складе: {', '.join(error.products)}. Измените корзину и попробуйте снова.",
+            reply_markup=main_menu
+        )
+        await state.clear()
         return
 
-    total_price = sum(item[2] * item[3] for item in cart_items)
-    
-    order_id = db.create_order(user_id, phone_number, total_price, None)
-
-    order_text = f"🆕 *Новый заказ #{order_id}* от {message.from_user.full_name} (ID: {user_id})\n"
-    order_text += f"📞 Телефон: {phone_number}\n"
-    order_text += "\n".join([f"{item[1]} - {item[3]} шт." for item in cart_items])
-    order_text += f"\n💰 *Итого:* {total_price}₽\n📦 *Статус:* 🟡 В обработке"
-
-    sent_message = await bot.send_message(GROUP_ID, order_text, parse_mode="Markdown", reply_markup=admin_panel(order_id))
+    if order is None:
+        await message.answer("❌ Ваша корзина пуста.", reply_markup=main_menu)
+        return
 
-    db.save_order_message_id(order_id, sent_message.message_id)
+    order_id, items, total_price = order
 
-    for item in cart_items:
-        db.update_stock(item[0], item[3])
+    card = render_order_message(
+        (order_id, user_id, message.from_user.full_name, phone_number, total_price, INITIAL_STATUS),
+        [(name, quantity) for _, name, _, quantity in items]
+    )
+    sent_message = await bot.send_message(GROUP_ID, card.text, parse_mode="HTML", reply_markup=card.markup)
 
-    db.clear_cart(user_id)
+    await db.save_order_message_id(order_id, sent_message.message_id)
 
     await message.answer('✅ Ваш заказ оформлен! Мы свяжемся с вами.', reply_markup=main_menu)
 
     await state.clear()
-    await state.clear()
 
 
 # Обработчик изменения статуса заказа
-@dp.callback_query(lambda c: c.data.startswith("status_"))
-async def change_order_status(callback: types.CallbackQuery):
-    chat_admins = await bot.get_chat_administrators(GROUP_ID)
-    admin_ids = [admin.user.id for admin in chat_admins]
-
-    if callback.from_user.id not in admin_ids:
+@callbacks.handler(OrderStatus)
+async def change_order_status(callback: types.CallbackQuery, callback_data: OrderStatus):
+    if not await admins.is_group_admin(callback.from_user.id):
         await callback.answer("❌ У вас нет прав для изменения статуса!", show_alert=True)
         return
 
-    _, order_id, new_status = callback.data.split("_")
-    order_id = int(order_id)
+    order_id = callback_data.order_id
 
-    db.update_order_status(order_id, new_status)
-
-    user_id = db.get_user_by_order(order_id)
-    message_id = db.get_order_message_id(order_id)
-
-    if not message_id:
-        await callback.answer("⚠ Не найдено сообщение заказа в группе!", show_alert=True)
+    # Проверка перехода, смена статуса и запись в историю - один запрос к БД
+    result = await db.transition_order(order_id, callback_data.status, callback.from_user.id)
+    if result is None:
+        await callback.answer("⚠ Статус заказа уже изменен или такой переход недоступен.", show_alert=True)
         return
 
-    status_map = {
-    "processing": "📦 В обработке",
-    "confirmed": "✅ Подтвержден",
-    "shipped": "🚚 В пути",
-    "canceled": "🛑 Отменен",
-    "completed": "🎉 Завершен"
-    }
+    order, message_id, items = result
+    user_id, status = order[1], order[5]
 
-    new_status_text = status_map.get(new_status, "🔄 В обработке")
-
-    updated_text = callback.message.text.split("\n📦 *Статус:*")[0] + f"\n📦 *Статус:* {new_status_text}"
-    await bot.edit_message_text(
-    text=updated_text,
-    chat_id=str(GROUP_ID), 
-    message_id=message_id,
-    parse_mode="Markdown",
-    reply_markup=callback.message.reply_markup
-)
-
-    if user_id:
-        await bot.send_message(user_id, f"📦 Ваш заказ #{order_id} теперь имеет статус: {new_status_text}")
+    # Текст и кнопки собираются из данных заказа; старое сообщение нужно только
+    # заказам, оформленным до того, как позиции и имя покупателя стали сохраняться
+    card = render_order_message(order, items, getattr(callback.message, "text", None))
+    try:
+        await bot.edit_message_text(
+            text=card.text,
+            chat_id=GROUP_ID,
+            message_id=message_id or callback.message.message_id,
+            parse_mode="HTML",
+            reply_markup=card.markup
+        )
+    except TelegramBadRequest as error:
+        if "message is not modified" not in error.message:
+            raise
 
     await callback.answer("✅ Статус заказа обновлен!")
+
+    # Уведомление покупателя - фоновая рассылка, ответы пользователям уходят раньше
+    with bulk():
+        await bot.send_message(user_id, f"📦 Ваш заказ #{order_id} теперь имеет статус: {order_status_label(status)}")
     
 
+# Изменение прав участников группы заказов: список администраторов обновляется без запроса к API
+@dp.chat_member(lambda event: event.chat.id == GROUP_ID)
+async def group_member_changed(event: types.ChatMemberUpdated):
+    admins.apply_member_update(event)
+
+
 # Команда для подсчета остатков на складе
 @dp.message(Command("count_products"))
 async def count_products(message: types.Message):
     # Проверка на администратора
-    if message.from_user.id != int(os.getenv('ADMIN_ID')):
+    if not admins.is_owner(message.from_user.id):
         await message.answer("❌ У вас нет доступа к этой команде.")
         return
 
     # Получаем список товаров и их количество из базы данных
-    products = db.get_all_products_with_stock()  
+    products = await db.get_all_products_with_stock()  
 
     if not products:
         await message.answer("❌ Товары не найдены в базе данных.")
@@ -626,8 +811,8 @@ async def count_products(message: types.Message):
     # Создаем список кнопок
     inline_buttons = []
     for product in products:
-        product_name, quantity = product  # Предполагается, что каждый элемент — это кортеж (название товара, количество)
-        button = InlineKeyboardButton(text=f"{product_name} - {quantity} шт.", callback_data=f"product_{product_name}")
+        product_id, product_name, quantity = product
+        button = InlineKeyboardButton(text=f"{product_name} - {quantity} шт.", callback_data=ProductDetails(product_id=product_id).pack())
         inline_buttons.append([button])  # Добавляем кнопку в строку
 
     # Создаем клавиатуру с кнопками
@@ -646,130 +831,153 @@ async def personal_account(message: types.Message):
 # Заказы пользователя
 @dp.message(lambda message: message.text == "📦 Мои заказы")
 async def my_orders(message: types.Message):
-    user_id = message.from_user.id
-    orders = db.get_orders_by_user(user_id)
+    page = await orders_page(message.from_user.id)
 
-    if not orders:
+    if not page:
         await message.answer("🛒 У вас пока нет заказов.")
         return
 
-    text = "📦 *Ваши заказы:*\n\n"
-    
-    moscow_timezone = pytz.timezone("Europe/Moscow")
-    
-    for order in orders:
-        print(order) 
-
-        order_id, date, total_price, status_code = order 
-        
-        status_dict = {
-            "processing": "📦 В обработке",
-            "confirmed": "✅ Подтвержден",
-            "shipped": "🚚 В пути",
-            "canceled": "🛑 Отменен",
-            "completed": "🎉 Завершен",
-            "failed": "❌ Неудача",
-            "pending": "⏳ Ожидает"  
-        }
-
-        status = status_dict.get(status_code, "Неизвестный статус") 
-        print(f"Получен статус: {status_code}")
-        order_date = date
-
-        order_date_obj = datetime.strptime(order_date, "%Y-%m-%d %H:%M:%S")
-        
-        order_date_obj = pytz.utc.localize(order_date_obj)  
-        order_date_obj = order_date_obj.astimezone(moscow_timezone)
-        
-        formatted_date = order_date_obj.strftime("%d.%m.%Y %H:%M")
-        text += f"🆔 *Заказ #{order_id}*\n📅 Дата: {formatted_date}\n💰 Сумма: {total_price}₽\n📦 Статус: *{status}*\n\n"
-
-    await message.answer(text, parse_mode="Markdown")
+    await message.answer(page.text, parse_mode="HTML", reply_markup=page.markup)
+
+
+# Листание истории заказов
+@callbacks.handler(OrdersPage)
+async def paginate_orders(callback: types.CallbackQuery, callback_data: OrdersPage):
+    page = await orders_page(callback.from_user.id, callback_data.cursor, callback_data.backward)
+
+    if not page:
+        await callback.answer("🛒 Заказов больше нет.", show_alert=True)
+        return
+
+    await edit_page(callback, page)
+
+
+async def orders_page(user_id, cursor=0, backward=False):
+    """Собирает страницу истории заказов пользователя"""
+    orders, has_prev, has_next = await db.get_orders_page(user_id, cursor, ORDERS_PAGE_SIZE, backward)
+    if not orders:
+        return None
+    return render_orders_page(orders, has_prev, has_next)
+
+
+# Состав заказа
+@callbacks.handler(OrderDetails)
+async def order_details(callback: types.CallbackQuery, callback_data: OrderDetails):
+    order = await db.get_order_details(callback_data.order_id, callback.from_user.id)
+
+    if not order:
+        await callback.answer("❌ Заказ не найден.", show_alert=True)
+        return
+
+    await edit_page(callback, render_order_details(*order))
 
 
 # Избранное
 @dp.message(lambda message: message.text == "❤️ Мое избранное")
 async def view_favorites(message: types.Message):
     user_id = message.from_user.id
-    favorites = db.get_favorites_by_user(user_id)
+    favorites = await db.get_favorites_by_user(user_id)
 
     if not favorites:
         await message.answer("Ваше избранное пусто.")
         return
 
-    text = "❤️ <b>Ваши избранные товары:</b>\n\n"
-    buttons = []
+    # Строки избранного уже содержат название и цены: дозапрашивать товары по одному не нужно
+    card = render_favorites(favorites)
+    await message.answer(card.text, parse_mode="HTML", reply_markup=card.markup)
 
-    for fav in favorites:
-        product_id = fav[0]
-        product_info = db.get_product_info_by_id(product_id)
 
-        if not product_info:
-            continue
+# Просмотр товара в избранном
+@callbacks.handler(ViewProduct)
+async def view_product_from_favorites(callback: types.CallbackQuery, callback_data: ViewProduct):
+    product_id = callback_data.product_id
+    card = await product_card(product_id, "favorite")
 
-        name = product_info["name"]
-        price = float(product_info["price"])
-        discount_price = float(product_info.get("discount_price", price))
+    if not card:
+        await callback.answer("❌ Товар не найден.", show_alert=True)
+        return
 
-        if discount_price < price:
-            discount_percent = round((1 - discount_price / price) * 100, 2)
-            text += f"🛍️ <b>{name}</b>\n🔥 <s>{price}₽</s> → <b>{discount_price}₽</b> (-{discount_percent}%)\n\n"
-        else:
-            text += f"🛍️ <b>{name}</b> - {price}₽\n"
-
-        # Добавляем кнопку для удаления товара из избранного
-        callback_data = f"remove_favorite_{product_id}"
-        print(f"DEBUG: создаем кнопку с callback_data: {callback_data}")
-        buttons.append([
-            InlineKeyboardButton(text=f"🔍 {name}", callback_data=f"view_product_{product_id}"),
-            InlineKeyboardButton(text="❌ Удалить", callback_data=callback_data)
-        ])
+    await answer_product_card(callback.message, product_id, card)
+    await callback.answer()
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
 
+# Удаление товара из избранного
+@callbacks.handler(RemoveFavorite)
+async def remove_favorite(callback: types.CallbackQuery, callback_data: RemoveFavorite):
+    user_id = callback.from_user.id
+    product_id = callback_data.product_id
+    await db.remove_favorite(user_id, product_id)
 
-# Просмотр товара в избранном
-@dp.callback_query(lambda c: c.data.startswith("view_product_"))
-async def view_product_from_favorites(callback: types.CallbackQuery):
-    product_id = int(callback.data.split("_")[2]) 
-    product = db.get_product_details(product_id)
+    await callback.answer("❌ Товар удалён из избранного.", show_alert=True)
+    await callback.message.delete()
 
-    if not product:
-        await callback.answer("❌ Товар не найден.", show_alert=True)
+
+# Кнопка-надпись (количество в корзине): просто убираем индикатор загрузки
+@callbacks.handler(Noop)
+async def ignore_button(callback: types.CallbackQuery, callback_data: Noop):
+    await callback.answer()
+
+
+# Все нажатия на inline-кнопки проходят через одну таблицу маршрутов
+dp.callback_query.register(callbacks.dispatch)
+
+
+# Поиск товаров: /search <запрос>; только в личных чатах - в группе заказов он мешал бы администраторам
+@dp.message(Command("search"), lambda message: message.chat.type == "private")
+async def search_command(message: types.Message, command: CommandObject):
+    if not command.args:
+        await message.answer("🔎 Напишите, что ищете, например: /search technic porsche")
         return
-    
-    name, description, price, discount_price, image = product
 
-    text = f"📌 <b>{name}</b>\n\n📄 {description}\n💰 Цена: {price}₽"
-    if discount_price < price:
-        discount_percent = round((1 - discount_price / price) * 100, 2)
-        text += f"\n🔥 <s>{price}₽</s> → <b>{discount_price}₽</b> (-{discount_percent}%)"
+    await send_search_results(message, command.args)
 
-    buttons = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="🛒 Купить", callback_data=f"add_to_cart_{product_id}")]
-        ]
-    )
 
-    if image and image.startswith("http"):
-        await callback.message.answer_photo(photo=image, caption=text, parse_mode="HTML", reply_markup=buttons)
-    else:
-        await callback.message.answer(text, parse_mode="HTML", reply_markup=buttons)
+# Листание результатов поиска
+@callbacks.handler(SearchPage)
+async def paginate_search(callback: types.CallbackQuery, callback_data: SearchPage):
+    page = await search_page(callback_data.query, callback_data.offset)
 
-    await callback.answer()
+    if page is None:
+        await callback.answer("❌ Больше ничего не найдено.", show_alert=True)
+        return
 
+    await edit_page(callback, page)
 
-# Удаление товара из избранного
-@dp.callback_query(lambda c: c.data.startswith("remove_favorite_"))
-async def remove_favorite(callback: types.CallbackQuery):
-    user_id = callback.from_user.id
-    parts = callback.data.split("_")
-    product_id = int(parts[2])
-    db.remove_favorite(user_id, product_id)
 
-    await callback.answer("❌ Товар удалён из избранного.", show_alert=True)
-    await callback.message.delete()
+async def send_search_results(message: types.Message, text):
+    page = await search_page(normalize_query(text))
+
+    if page is None:
+        await message.answer("😔 По вашему запросу ничего не найдено.")
+        return
+
+    await message.answer(page.text, reply_markup=page.markup, parse_mode="HTML")
+
+
+def normalize_query(text):
+    """Приводит запрос к словам через пробел, укладываясь в лимит callback_data"""
+    query = ""
+    for term in search_terms(text):
+        candidate = f"{query} {term}".strip()
+        if len(candidate.encode()) > SEARCH_QUERY_BYTES:
+            break
+        query = candidate
+    return query
+
+
+async def search_page(query, offset=0):
+    """Собирает страницу результатов поиска или возвращает None, если ничего не найдено"""
+    products, has_next = await db.search_products(query, offset, SEARCH_PAGE_SIZE)
+    if not products:
+        return None
+    return render_search_results(query, products, offset, SEARCH_PAGE_SIZE, has_next)
+
+
+# Отмена оформления заказа
+@dp.message(lambda message: message.text == "❌ Отменить заказ")
+async def cancel_order(message: types.Message, state: FSMContext):
+    await state.clear()
+    await message.answer("❌ Оформление заказа отменено.", reply_markup=main_menu)
 
 
 # Возвращение в главное меню
@@ -799,12 +1007,139 @@ async def contacts(message: types.Message):
     await message.answer("📞 +7 977 412 60 27\n📧 Email: example@mail.com")
 
 
+# Любой другой текст вне сценариев в личном чате считается поисковым запросом.
+# Регистрируется последним, чтобы не перехватывать кнопки меню
+@router.message(
+    StateFilter(None),
+    lambda message: message.chat.type == "private" and message.text and not message.text.startswith("/")
+)
+async def free_text_search(message: types.Message):
+    await send_search_results(message, message.text)
+
+
 # Запуск бота
 async def main():
-    logging.basicConfig(level=logging.INFO)
+    log_listener = monitoring.setup_logging(logging.INFO)
+    dp.include_router(router)
+    logging.info("🚀 Бот запущен!", extra={
+        "mode": "webhook" if WEBHOOK_URL else "polling", "workers": WORKERS, "metrics_port": METRICS_PORT
+    })
+    try:
+        if WORKERS > 1:
+            await run_front()
+        else:
+            await run_single()
+    finally:
+        await dp.storage.close()
+        await db.close()
+        log_listener.stop()
+
+
+async def sweep_reservations(interval=RESERVATION_SWEEP_INTERVAL):
+    """Фоновая очистка истекших резервов корзин"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            expired = await db.expire_reservations()
+        except Exception:
+            logging.exception("Не удалось очистить резервы")
+            continue
+        if expired:
+            logging.info("Истекшие резервы удалены", extra={"count": expired})
+
+
+async def sync_catalog(interval=CATALOG_SYNC_INTERVAL):
+    """Фоновая сверка кэша каталога с правками других процессов.
+
+    Запрос к catalog_state идет в пуле потоков: страницы из кэша рендеринга
+    берут версию каталога без обращения к БД."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await db.run("_sync_catalog")
+        except Exception:
+            logging.exception("Не удалось сверить кэш каталога")
+
+
+async def run_single():
+    """Обычный режим: один процесс принимает и обрабатывает обновления"""
+    monitoring.setup(dp, metrics)
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = await monitoring.start_metrics_server(metrics, port=METRICS_PORT)
+    sweeper = asyncio.create_task(sweep_reservations())
+    try:
+        if WEBHOOK_URL:
+            await run_webhook(
+                dp, bot, WEBHOOK_URL, WEBHOOK_SECRET or default_secret(TOKEN),
+                host=WEBHOOK_HOST, port=WEBHOOK_PORT, concurrency=WEBHOOK_CONCURRENCY, register=WEBHOOK_REGISTER
+            )
+        else:
+            # getUpdates не работает, пока у бота установлен вебхук
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        sweeper.cancel()
+        if metrics_server:
+            await metrics_server.cleanup()
+
+
+async def run_front():
+    """Многопроцессный режим: этот процесс только принимает обновления и раскладывает их
+    по WORKERS процессам-обработчикам по id пользователя"""
+    processes, queues = workers.start_workers(WORKERS)
+    partitioner = workers.Partitioner(queues)
+    allowed_updates = dp.resolve_used_update_types()
+    try:
+        if WEBHOOK_URL:
+            secret = WEBHOOK_SECRET or default_secret(TOKEN)
+            if WEBHOOK_REGISTER:
+                await bot.set_webhook(WEBHOOK_URL, secret_token=secret, allowed_updates=allowed_updates)
+            await workers.serve_webhook(
+                partitioner, urlsplit(WEBHOOK_URL).path or "/", secret, WEBHOOK_HOST, WEBHOOK_PORT
+            )
+        else:
+            await bot.delete_webhook()
+            await workers.poll(bot, partitioner, allowed_updates)
+    finally:
+        await asyncio.to_thread(workers.stop_workers, processes, queues)
+        await bot.session.close()
+
+
+async def run_worker(index, count, updates, session_factory=None, on_ready=None):
+    """Процесс-обработчик многопроцессного режима.
+
+    Лимиты отправки делятся между процессами, кэш каталога сверяется с правками
+    соседей. session_factory подменяет HTTP-сессию Bot API вместе с ее middleware
+    (так бенчмарк работает без сети). Возвращает (обработано, ошибок)."""
+    log_listener = monitoring.setup_logging(logging.INFO)
+    if session_factory is not None:
+        bot.session = session_factory()
+    sender.share(count)
+    db.db.watch_catalog(CATALOG_SYNC_INTERVAL)
     dp.include_router(router)
-    print("🚀 Бот запущен!")
-    await dp.start_polling(bot)
+    monitoring.setup(dp, metrics)
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = await monitoring.start_metrics_server(metrics, port=METRICS_PORT + 1 + index)
+    # Резервы общие для всех процессов - очищает их только первый
+    sweeper = asyncio.create_task(sweep_reservations()) if index == 0 else None
+    syncer = asyncio.create_task(sync_catalog())
+    if on_ready is not None:
+        on_ready()
+    try:
+        return await workers.consume(dp, bot, updates, WEBHOOK_CONCURRENCY)
+    finally:
+        if sweeper:
+            sweeper.cancel()
+        syncer.cancel()
+        if metrics_server:
+            await metrics_server.cleanup()
+        await dp.storage.close()
+        await db.close()
+        await bot.session.close()
+        log_listener.stop()
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
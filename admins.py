@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import time
+
+# Статусы участника группы, дающие право менять статусы заказов
+ADMIN_STATUSES = {"creator", "administrator"}
+
+
+class AdminCache:
+    """Права администраторов в памяти процесса.
+
+    Владелец магазина (ADMIN_ID) проверяется простым сравнением. Список
+    администраторов группы заказов запрашивается у Bot API один раз и живет ttl
+    секунд; устаревший список продолжает отдаваться, пока в фоне идет обновление.
+    Обновления chat_member применяются к списку сразу."""
+
+    def __init__(self, bot, group_id, owner_id, ttl=300):
+        self.bot = bot
+        self.group_id = group_id
+        self.owner_id = owner_id
+        self.ttl = ttl
+        self._admins = None
+        self._expires_at = 0.0
+        self._refreshing = None
+
+    def is_owner(self, user_id):
+        """Проверяет, что пользователь - владелец магазина"""
+        return user_id == self.owner_id
+
+    async def is_group_admin(self, user_id):
+        """Проверяет, что пользователь - администратор группы заказов"""
+        if self._admins is None:
+            await asyncio.shield(self.refresh())
+        elif time.monotonic() >= self._expires_at:
+            self.refresh()
+        return user_id in self._admins
+
+    def refresh(self):
+        """Запускает загрузку списка администраторов; параллельные вызовы получают один и тот же запрос"""
+        if self._refreshing is None:
+            self._refreshing = asyncio.create_task(self._load())
+        return self._refreshing
+
+    async def _load(self):
+        try:
+            chat_admins = await self.bot.get_chat_administrators(self.group_id)
+            self._admins = {admin.user.id for admin in chat_admins}
+            self._expires_at = time.monotonic() + self.ttl
+        except Exception:
+            if self._admins is None:
+                raise
+            logging.exception("Не удалось обновить список администраторов группы")
+        finally:
+            self._refreshing = None
+
+    def apply_member_update(self, event):
+        """Учитывает повышение или понижение участника группы из обновления chat_member"""
+        if self._admins is None:
+            return
+        user_id = event.new_chat_member.user.id
+        if event.new_chat_member.status in ADMIN_STATUSES:
+            self._admins.add(user_id)
+        else:
+            self._admins.discard(user_id)
+
+    def invalidate(self):
+        """Сбрасывает список: следующая проверка загрузит его заново"""
+        self._admins = None
+        self._expires_at = 0.0
@@ -0,0 +1,439 @@
+"""Нагрузочный тест и микробенчмарки бота без сети.
+
+Настоящий диспетчер dp из add.py получает синтетические обновления, а вместо
+Bot API отвечает FakeBotSession. N пользователей одновременно проходят сценарий
+каталог → подробнее → в корзину → корзина → ➕/➖ → оформление, администратор
+меняет статус каждого заказа. Результат - JSON, который удобно сравнивать
+между запусками:
+
+    python bench.py --users 50 --products 2000 --output before.json
+
+С --workers тот же сценарий (без администратора) проходит через многопроцессный
+режим из workers.py для каждого указанного числа процессов:
+
+    python bench.py --workers 1,2,4,8 --skip-micro
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+
+# add.py читает настройки при импорте
+os.environ.setdefault("TOKEN", "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("GROUP_ID", "-1001")
+os.environ["METRICS_PORT"] = "0"
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update
+
+ADMIN_ID = int(os.environ["ADMIN_ID"])
+GROUP_ID = int(os.environ["GROUP_ID"])
+
+WORDS = (
+    "LEGO", "Technic", "City", "Star", "Wars", "Creator", "Ninjago", "Friends", "Duplo", "Ideas",
+    "замок", "корабль", "поезд", "самолет", "гоночный", "полицейский", "пожарный", "космический",
+)
+
+current_action = ContextVar("current_action", default="other")
+
+
+def percentiles(values):
+    """p50/p95/p99/max в миллисекундах"""
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1] * 1000, 3)}
+
+
+class FakeBotSession(BaseSession):
+    """Сессия, которая отвечает на запросы Bot API локально и считает их по действиям сценария"""
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = defaultdict(Counter)
+        self._message_ids = itertools.count(1000)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[current_action.get()][name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if name == "GetChatAdministrators":
+            result = [{"status": "creator", "is_anonymous": False,
+                       "user": {"id": ADMIN_ID, "is_bot": False, "first_name": "admin"}}]
+        elif name == "GetMe":
+            result = {"id": 42, "is_bot": True, "first_name": "bot", "username": "bench_bot"}
+        elif name in ("AnswerCallbackQuery", "DeleteMessage", "EditMessageReplyMarkup"):
+            result = True
+        elif name == "SendMediaGroup":
+            result = [self._message(method, photo=True) for _ in method.media]
+        else:
+            result = self._message(method, photo=name == "SendPhoto")
+        return self.check_response(bot, method, 200, json.dumps({"ok": True, "result": result})).result
+
+    def _message(self, method, photo=False):
+        chat_id = int(getattr(method, "chat_id", None) or 1)
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "text": getattr(method, "text", None) or "x",
+        }
+        if photo:
+            message["photo"] = [{"file_id": f"bench-{message['message_id']}", "file_unique_id": "u", "width": 1, "height": 1}]
+        return message
+
+
+def fake_session(latency=0.0, telegram_limits=False):
+    """FakeBotSession с теми же middleware, что у настоящей сессии бота"""
+    import monitoring
+    from sender import SendScheduler
+
+    session = FakeBotSession(latency)
+    if telegram_limits:
+        session.scheduler = SendScheduler()
+    else:
+        session.scheduler = SendScheduler(global_rate=10 ** 9, private_rate=10 ** 9, group_rate=10 ** 9, burst=10 ** 9)
+    session.middleware(session.scheduler)
+    session.middleware(monitoring.ApiTimer())
+    return session
+
+
+class UpdateFactory:
+    """Синтетические обновления Telegram"""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def message(self, user_id, text=None, **extra):
+        message = {
+            "message_id": next(self._ids), "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id),
+        }
+        if text is not None:
+            message["text"] = text
+        message.update(extra)
+        return Update.model_validate({"update_id": next(self._ids), "message": message})
+
+    def callback(self, user_id, data, message_id=1, chat_id=None, text="x"):
+        chat_id = chat_id or user_id
+        return Update.model_validate({"update_id": next(self._ids), "callback_query": {
+            "id": str(next(self._ids)), "from": self._user(user_id), "chat_instance": "bench", "data": data,
+            "message": {
+                "message_id": message_id, "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "from": {"id": 42, "is_bot": True, "first_name": "bot"},
+            },
+        }})
+
+
+class Scenario:
+    def __init__(self, add, session, products, rounds):
+        self.add = add
+        self.session = session
+        self.products = products
+        self.rounds = rounds
+        self.updates = UpdateFactory()
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+
+    async def feed(self, action, update):
+        token = current_action.set(action)
+        started = time.perf_counter()
+        try:
+            await self.add.dp.feed_update(self.add.bot, update)
+        except Exception:
+            self.errors[action] += 1
+        finally:
+            self.latencies[action].append(time.perf_counter() - started)
+            current_action.reset(token)
+
+    async def user(self, user_id, rng):
+        db = self.add.db
+        for _ in range(self.rounds):
+            product_id = rng.randint(1, self.products)
+            await self.feed("catalog", self.updates.message(user_id, "🛍 Каталог"))
+            await self.feed("details", self.updates.callback(user_id, f"pd:{product_id}"))
+            await self.feed("add_to_cart", self.updates.callback(user_id, f"ca:{product_id}"))
+            await self.feed("cart", self.updates.message(user_id, "🛒 Корзина"))
+
+            cart_message = 10 ** 6 + user_id
+            await self.feed("cart_increase", self.updates.callback(user_id, f"ci:{product_id}", cart_message))
+            await self.feed("cart_decrease", self.updates.callback(user_id, f"cd:{product_id}", cart_message))
+
+            await self.feed("offer", self.updates.callback(user_id, "co"))
+            await self.feed("confirm", self.updates.message(user_id, "✅ Подтвердить заказ"))
+            contact = {"phone_number": f"+7900{user_id:07d}", "first_name": "bench", "user_id": user_id}
+            await self.feed("checkout", self.updates.message(user_id, contact=contact))
+
+            orders, _, _ = await db.get_orders_page(user_id, 0, 1)
+            if orders:
+                order_id = orders[0][0]
+                message_id = await db.get_order_message_id(order_id)
+                for status in ("confirmed", "shipped"):
+                    await self.feed("order_status", self.updates.callback(
+                        ADMIN_ID, f"os:{order_id}:{status}", message_id or 1, GROUP_ID
+                    ))
+
+    async def run(self, users, seed):
+        rng = random.Random(seed)
+        started = time.perf_counter()
+        await asyncio.gather(*(self.user(10_000 + number, random.Random(rng.random())) for number in range(users)))
+        return time.perf_counter() - started
+
+
+def fill_catalog(db, products, seed):
+    """Генерирует каталог из products товаров с большим запасом на складе"""
+    rng = random.Random(seed)
+    rows = []
+    for number in range(products):
+        name = " ".join(rng.sample(WORDS, 3)) + f" {number}"
+        price = rng.randint(500, 50000)
+        discount_price = price if rng.random() < 0.7 else round(price * rng.uniform(0.5, 0.95))
+        rows.append((name, f"Набор {name}: {' '.join(rng.sample(WORDS, 6))}", price, discount_price, 10 ** 6))
+    with db.pool.writer() as conn:
+        conn.executemany(
+            "INSERT INTO products (name, description, price, discount_price, quantity) VALUES (?, ?, ?, ?, ?)", rows
+        )
+    db.cache.invalidate()
+
+
+def microbench(path, products, iterations, seed):
+    """Прямые вызовы методов Database без бота: операций в секунду и p50/p99"""
+    from database import Database
+
+    db = Database(path)
+    fill_catalog(db, products, seed)
+    rng = random.Random(seed)
+    user_id = 7
+    with db.pool.writer() as conn:
+        conn.executemany(
+            "INSERT INTO orders (user_id, phone_number, total_price, status) VALUES (?, '+7', ?, 'pending')",
+            [(user_id, rng.randint(100, 10000)) for _ in range(200)]
+        )
+    for product_id in range(1, min(products, 50) + 1):
+        db.add_to_favorites(user_id, product_id)
+
+    def product():
+        return rng.randint(1, products)
+
+    cases = {
+        "get_product_info": lambda: db.get_product_info(product()),
+        "get_product_details": lambda: db.get_product_details(product()),
+        "get_products_by_ids": lambda: db.get_products_by_ids([product() for _ in range(20)]),
+        "get_catalog_page": lambda: db.get_catalog_page(rng.randint(0, products), 5),
+        "get_products_sorted_by_discount": lambda: db.get_products_sorted_by_discount(),
+        "search_products": lambda: db.search_products(rng.choice(WORDS), 0, 5),
+        "add_to_cart": lambda: db.add_to_cart(user_id, product(), 1),
+        "increase_cart_item": lambda: db.increase_cart_item(user_id, product()),
+        "decrease_cart_item": lambda: db.decrease_cart_item(user_id, product()),
+        "show_cart": lambda: db.show_cart(user_id),
+        "get_favorites_by_user": lambda: db.get_favorites_by_user(user_id),
+        "get_orders_page": lambda: db.get_orders_page(user_id, 0, 5),
+        "transition_order": lambda: db.transition_order(
+            rng.randint(1, 200), rng.choice(("processing", "confirmed", "shipped", "completed"))
+        ),
+    }
+
+    results = {}
+    for name, call in cases.items():
+        timings = []
+        started = time.perf_counter()
+        for _ in range(iterations):
+            call_started = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - call_started)
+        elapsed = time.perf_counter() - started
+        results[name] = {"ops_per_sec": round(iterations / elapsed, 1), **percentiles(timings)}
+
+    db.add_to_cart(user_id, 1, 1)
+    timings = []
+    for _ in range(iterations):
+        db.add_to_cart(user_id, product(), 1)
+        call_started = time.perf_counter()
+        db.place_order(user_id, "+7")
+        timings.append(time.perf_counter() - call_started)
+    results["place_order"] = {"ops_per_sec": round(len(timings) / sum(timings), 1), **percentiles(timings)}
+
+    db.close()
+    return results
+
+
+async def scenario(args):
+    import add
+
+    session = fake_session(args.api_latency / 1000, args.telegram_limits)
+    add.bot.session = session
+    add.dp.include_router(add.router)
+
+    fill_catalog(add.db.db, args.products, args.seed)
+    pool_before = add.db.db.pool_stats()
+
+    runner = Scenario(add, session, args.products, args.rounds)
+    elapsed = await runner.run(args.users, args.seed)
+
+    updates = sum(len(values) for values in runner.latencies.values())
+    pool = add.db.db.pool_stats()
+    actions = {}
+    for action, values in runner.latencies.items():
+        calls = session.calls.get(action, Counter())
+        actions[action] = {
+            "count": len(values),
+            "errors": runner.errors[action],
+            "latency_ms": percentiles(values),
+            "api_calls_per_action": round(sum(calls.values()) / len(values), 2),
+            "api_calls": dict(calls),
+        }
+
+    result = {
+        "updates": updates,
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(updates / elapsed, 1),
+        "latency_ms": percentiles([value for values in runner.latencies.values() for value in values]),
+        "actions": actions,
+        "sqlite": {key: pool[key] - pool_before[key] for key in pool},
+        "send": session.scheduler.stats(),
+        "product_cache": add.db.db.cache_stats(),
+        "render_cache": add.cards.stats(),
+    }
+    await add.dp.storage.close()
+    await add.db.close()
+    return result
+
+
+def user_flow(updates, user_id, product_id):
+    """Обновления одного прохода сценария без участия администратора"""
+    cart_message = 10 ** 6 + user_id
+    contact = {"phone_number": f"+7900{user_id:07d}", "first_name": "bench", "user_id": user_id}
+    return [
+        updates.message(user_id, "🛍 Каталог"),
+        updates.callback(user_id, f"pd:{product_id}"),
+        updates.callback(user_id, f"ca:{product_id}"),
+        updates.message(user_id, "🛒 Корзина"),
+        updates.callback(user_id, f"ci:{product_id}", cart_message),
+        updates.callback(user_id, f"cd:{product_id}", cart_message),
+        updates.callback(user_id, "co"),
+        updates.message(user_id, "✅ Подтвердить заказ"),
+        updates.message(user_id, contact=contact),
+    ]
+
+
+def workers_bench(args, counts):
+    """Пропускная способность многопроцессного режима для разного числа процессов.
+
+    Фронт раскладывает заранее подготовленные обновления по процессам так же, как
+    в боевом режиме; время считается от первого обновления до момента, когда все
+    процессы обработали свои очереди."""
+    import multiprocessing
+    from functools import partial
+
+    import workers
+    from database import Database
+
+    db = Database("shop.db")
+    fill_catalog(db, args.products, args.seed)
+    db.close()
+
+    rng = random.Random(args.seed)
+    factory = UpdateFactory()
+    flows = [
+        [update for _ in range(args.rounds) for update in user_flow(factory, 10_000 + number, rng.randint(1, args.products))]
+        for number in range(args.users)
+    ]
+    # Пользователи действуют одновременно: обновления чередуются между ними
+    raw_updates = [
+        update.model_dump(mode="json", exclude_none=True, by_alias=True)
+        for step in itertools.zip_longest(*flows) for update in step if update is not None
+    ]
+
+    results = multiprocessing.get_context("spawn").Queue()
+    runs = []
+    for count in counts:
+        session_factory = partial(fake_session, args.api_latency / 1000, args.telegram_limits)
+        processes, queues = workers.start_workers(count, results, session_factory)
+        for _ in range(count):
+            results.get()
+
+        partitioner = workers.Partitioner(queues)
+        started = time.perf_counter()
+        for update in raw_updates:
+            partitioner.route(update)
+        for queue in queues:
+            queue.put(None)
+        done = [results.get() for _ in range(count)]
+        elapsed = time.perf_counter() - started
+        for process in processes:
+            process.join()
+
+        processed = sum(message[2] for message in done)
+        runs.append({
+            "workers": count,
+            "updates": processed,
+            "errors": sum(message[3] for message in done),
+            "seconds": round(elapsed, 3),
+            "updates_per_sec": round(processed / elapsed, 1),
+            "updates_per_worker": partitioner.routed,
+        })
+    return {"cpu_count": os.cpu_count(), "runs": runs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="одновременных пользователей")
+    parser.add_argument("--rounds", type=int, default=3, help="проходов сценария на пользователя")
+    parser.add_argument("--products", type=int, default=1000, help="товаров в каталоге")
+    parser.add_argument("--iterations", type=int, default=2000, help="вызовов на микробенчмарк")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, мс")
+    parser.add_argument("--telegram-limits", action="store_true", help="соблюдать лимиты отправки Telegram")
+    parser.add_argument("--skip-micro", action="store_true", help="только сценарий")
+    parser.add_argument("--workers", help="сравнить многопроцессный режим, например 1,2,4,8")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    workdir = tempfile.TemporaryDirectory(prefix="shop-bench-")
+    # add.py открывает shop.db в текущем каталоге: база бенчмарка живет во временном
+    os.chdir(workdir.name)
+
+    report = {"config": vars(args), "python": sys.version.split()[0]}
+    if args.workers:
+        report["workers"] = workers_bench(args, [int(count) for count in args.workers.split(",")])
+    else:
+        report["scenario"] = asyncio.run(scenario(args))
+    if not args.skip_micro:
+        report["microbench"] = microbench(os.path.join(workdir.name, "micro.db"), args.products, args.iterations, args.seed)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
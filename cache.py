@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+
+
+class ProductCache:
+    """Кэш каталога в памяти процесса.
+
+    Хранит строки товаров по id (с вытеснением давно не запрошенных - LRU) и готовые
+    списки: страницы каталога, сортировку по скидке, остатки. Каталог меняется редко,
+    поэтому любая правка товара сбрасывает списки и увеличивает версию каталога.
+    Изменение остатков версию не трогает: количество правится прямо в кэше."""
+
+    def __init__(self, max_products=5000):
+        self.max_products = max_products
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._generation = 0
+        self._products = OrderedDict()
+        self._lists = {}
+        self._lock = threading.RLock()
+
+    def generation(self):
+        """Номер изменения кэша; берется до запроса в БД и передается в put/put_list"""
+        return self._generation
+
+    def get(self, product_id):
+        """Возвращает строку товара (id, name, description, price, discount_price, quantity, image,
+        image_file_id) или None"""
+        with self._lock:
+            row = self._products.get(product_id)
+            if row is None:
+                self.misses += 1
+                return None
+            self._products.move_to_end(product_id)
+            self.hits += 1
+            return row
+
+    def put(self, row, generation):
+        """Кладет строку товара, если с момента чтения из БД кэш не менялся"""
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._products[row[0]] = row
+            self._products.move_to_end(row[0])
+            while len(self._products) > self.max_products:
+                self._products.popitem(last=False)
+
+    def get_list(self, key):
+        with self._lock:
+            rows = self._lists.get(key)
+            if rows is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return rows
+
+    def put_list(self, key, rows, generation):
+        with self._lock:
+            if generation == self._generation:
+                self._lists[key] = rows
+
+    def invalidate(self, product_id=None):
+        """Сбрасывает товар (или весь кэш, если product_id не указан) и все списки"""
+        with self._lock:
+            if product_id is None:
+                self._products.clear()
+            else:
+                self._products.pop(product_id, None)
+            self._lists.clear()
+            self._generation += 1
+            self.version += 1
+
+    def patch_quantity(self, product_id, delta):
+        """Меняет остаток товара в кэше, не сбрасывая остальной каталог"""
+        with self._lock:
+            row = self._products.get(product_id)
+            if row is not None:
+                self._products[product_id] = row[:5] + (row[5] - delta,) + row[6:]
+            self._lists.pop("stock", None)
+            self._generation += 1
+
+    def patch_image_file_id(self, product_id, file_id):
+        """Меняет file_id фото товара в кэше; на отрисовку списков он не влияет"""
+        with self._lock:
+            row = self._products.get(product_id)
+            if row is not None:
+                self._products[product_id] = row[:7] + (file_id,)
+            self._generation += 1
+
+    def drop_stock(self):
+        """Забывает остатки, измененные другим процессом: строки товаров и список остатков
+        перечитываются при следующем запросе, версия каталога не меняется"""
+        with self._lock:
+            self._products.clear()
+            self._lists.pop("stock", None)
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "products": len(self._products),
+                "lists": len(self._lists),
+                "version": self.version,
+            }
@@ -0,0 +1,121 @@
+import inspect
+
+from aiogram.filters.callback_data import CallbackData
+
+from monitoring import label_handler
+
+
+# Компактные типизированные callback_data. Префикс - код операции, по которому
+# CallbackRouter выбирает обработчик; pack() гарантирует лимит Telegram в 64 байта.
+
+class CatalogPage(CallbackData, prefix="cp"):
+    cursor: int
+    backward: bool = False
+
+
+class GalleryPage(CallbackData, prefix="gp"):
+    cursor: int
+
+
+class SearchPage(CallbackData, prefix="sp"):
+    offset: int
+    query: str
+
+
+class ProductDetails(CallbackData, prefix="pd"):
+    product_id: int
+
+
+class ViewProduct(CallbackData, prefix="pv"):
+    product_id: int
+
+
+class AddToCart(CallbackData, prefix="ca"):
+    product_id: int
+
+
+class CartIncrease(CallbackData, prefix="ci"):
+    product_id: int
+
+
+class CartDecrease(CallbackData, prefix="cd"):
+    product_id: int
+
+
+class CartRemove(CallbackData, prefix="cr"):
+    product_id: int
+
+
+class Checkout(CallbackData, prefix="co"):
+    pass
+
+
+class AddFavorite(CallbackData, prefix="fa"):
+    product_id: int
+
+
+class RemoveFavorite(CallbackData, prefix="fr"):
+    product_id: int
+
+
+class DeleteProduct(CallbackData, prefix="dp"):
+    product_id: int
+
+
+class OrderStatus(CallbackData, prefix="os"):
+    order_id: int
+    status: str
+
+
+class OrdersPage(CallbackData, prefix="op"):
+    cursor: int
+    backward: bool = False
+
+
+class OrderDetails(CallbackData, prefix="od"):
+    order_id: int
+
+
+class Noop(CallbackData, prefix="no"):
+    pass
+
+
+class CallbackRouter:
+    """Таблица маршрутов для нажатий на inline-кнопки.
+
+    Вместо цепочки фильтров, которые aiogram проверяет по очереди, один обработчик
+    берет код операции до первого ':' и находит нужную функцию одним поиском в
+    словаре. Функция получает разобранный объект callback_data и только те
+    аргументы aiogram (state, bot, ...), которые объявлены в ее сигнатуре."""
+
+    def __init__(self):
+        self._routes = {}
+
+    def handler(self, payload_type):
+        """Регистрирует обработчик для callback_data типа payload_type"""
+        def decorator(func):
+            prefix = payload_type.__prefix__
+            if prefix in self._routes:
+                raise ValueError(f"Код операции {prefix!r} уже занят")
+            parameters = inspect.signature(func).parameters
+            self._routes[prefix] = (payload_type, func, frozenset(list(parameters)[2:]))
+            return func
+        return decorator
+
+    async def dispatch(self, callback, **data):
+        """Единый обработчик callback_query для диспетчера"""
+        prefix = (callback.data or "").partition(":")[0]
+        route = self._routes.get(prefix)
+        if route is None:
+            await callback.answer("⚠ Кнопка устарела, откройте меню заново.", show_alert=True)
+            return
+
+        payload_type, func, wanted = route
+        label_handler(func.__name__)
+        try:
+            payload = payload_type.unpack(callback.data)
+        except (TypeError, ValueError):
+            await callback.answer("⚠ Ошибка: некорректный запрос!", show_alert=True)
+            return
+
+        return await func(callback, payload, **{name: data[name] for name in wanted if name in data})
@@ -0,0 +1,160 @@
+"""Импорт и экспорт каталога файлами CSV и JSON.
+
+Файл читается потоком: строки разбираются по одной, проверяются правилами из
+validation и записываются пачками по CHUNK_SIZE, каждая - одной транзакцией.
+Прайс-лист на тысячи позиций загружается за секунды и не держится в памяти целиком."""
+import csv
+import json
+
+from validation import parse_discount_price, parse_image, parse_name, parse_price, parse_quantity
+
+# Колонки файла в порядке колонок таблицы products
+FIELDS = ("name", "description", "price", "discount_price", "quantity", "image")
+CHUNK_SIZE = 500
+READ_SIZE = 64 * 1024
+# Сколько ошибок с номерами строк хранить для отчета
+MAX_ERRORS = 20
+
+FORMATS = {".csv": "csv", ".json": "json", ".jsonl": "json", ".ndjson": "json"}
+
+
+def detect_format(filename):
+    """csv, json или None по расширению файла"""
+    name = (filename or "").lower()
+    return next((fmt for extension, fmt in FORMATS.items() if name.endswith(extension)), None)
+
+
+class ImportReport:
+    """Итог импорта: счетчики, первые MAX_ERRORS ошибок (номер строки, причина) и причина,
+    по которой файл не дочитан (битая кодировка или синтаксис)"""
+
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.rejected = 0
+        self.errors = []
+        self.stopped = None
+
+    def reject(self, number, error):
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((number, str(error)))
+
+
+def read_csv(stream):
+    """(номер строки, словарь полей); разделитель , ; или табуляция определяется по началу файла"""
+    sample = stream.read(4096)
+    stream.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(stream, dialect=dialect)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_json(stream):
+    """(номер объекта, объект) из JSON-массива или JSON Lines без чтения файла целиком"""
+    decoder = json.JSONDecoder()
+    buffer, position, number = "", 0, 0
+    while True:
+        # Между объектами могут стоять только пробелы, запятые и скобки массива
+        while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+            position += 1
+        if position < len(buffer):
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                pass  # объект обрезан границей порции - дочитываем
+            else:
+                number += 1
+                yield number, item
+                continue
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            if position < len(buffer):
+                raise ValueError(f"JSON поврежден после объекта {number}")
+            return
+        buffer, position = buffer[position:] + chunk, 0
+
+
+def validate(row):
+    """Кортеж колонок products из строки файла; ValueError с причиной, если строка не подходит"""
+    if not isinstance(row, dict):
+        raise ValueError("Ожидался объект с полями товара.")
+    row = {str(key).strip().lower(): value for key, value in row.items() if key is not None}
+    name = parse_name(row.get("name"))
+    price = parse_price(row.get("price"))
+    discount = row.get("discount_price")
+    # Пустая скидочная цена - товар без скидки
+    if discount is None or str(discount).strip() == "":
+        discount_price = price
+    else:
+        discount_price = parse_discount_price(discount, price)
+    return (
+        name, str(row.get("description") or "").strip(), price, discount_price,
+        parse_quantity(row.get("quantity")), parse_image(row.get("image")),
+    )
+
+
+def import_file(db, path, fmt, chunk_size=CHUNK_SIZE):
+    """Загружает товары из файла в Database db; возвращает ImportReport.
+
+    Если файл поврежден, строки до места повреждения все равно сохраняются."""
+    report = ImportReport()
+    chunk = []
+
+    def flush():
+        inserted, updated = db.upsert_products(chunk)
+        report.inserted += inserted
+        report.updated += updated
+        chunk.clear()
+
+    with open(path, encoding="utf-8-sig", newline="") as stream:
+        rows = read_csv(stream) if fmt == "csv" else read_json(stream)
+        try:
+            for number, row in rows:
+                try:
+                    chunk.append(validate(row))
+                except ValueError as error:
+                    report.reject(number, error)
+                if len(chunk) >= chunk_size:
+                    flush()
+        except (ValueError, csv.Error) as error:
+            report.stopped = str(error)
+    if chunk:
+        flush()
+    return report
+
+
+def export_file(db, path, fmt):
+    """Выгружает каталог из Database db в файл порциями; возвращает число товаров"""
+    count = 0
+    if fmt == "csv":
+        # utf-8-sig - чтобы Excel сразу открыл кириллицу
+        with open(path, "w", encoding="utf-8-sig", newline="") as stream:
+            writer = csv.writer(stream)
+            writer.writerow(FIELDS)
+            for rows in db.iter_products():
+                writer.writerows(export_row(row) for row in rows)
+                count += len(rows)
+        return count
+
+    with open(path, "w", encoding="utf-8") as stream:
+        stream.write("[")
+        for rows in db.iter_products():
+            for row in rows:
+                stream.write(",\n" if count else "\n")
+                json.dump(dict(zip(FIELDS, export_row(row))), stream, ensure_ascii=False)
+                count += 1
+        stream.write("\n]\n")
+    return count
+
+
+def export_row(row):
+    """Строка для файла: товар без скидки выгружается с пустой скидочной ценой"""
+    name, description, price, discount_price, quantity, image = row
+    if discount_price is None or discount_price >= price:
+        discount_price = ""
+    return name, description, price, discount_price, quantity, image or ""
@@ -0,0 +1 @@
+# Модули бота лежат в корне репозитория: этот файл добавляет корень в sys.path для tests/
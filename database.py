@@ -1,356 +1,883 @@
+import asyncio
+import queue
+import re
 import sqlite3
-from contextlib import closing
-
-class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect("shop.db")
-        self.cursor = self.conn.cursor()
-        self.add_phone_number_column()
-        self.create_tables()
-
-    def create_tables(self):
-        """Создает таблицы, если их нет"""
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT,
-                description TEXT,
-                price REAL,
-                discount_price REAL,
-                quantity INTEGER,
-                image TEXT
-            )
-        """)
-
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS cart (
-                user_id INTEGER,
-                product_id INTEGER,
-                quantity INTEGER,
-                PRIMARY KEY (user_id, product_id),
-                FOREIGN KEY (product_id) REFERENCES products (id)
-            )
-        """)
-
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                phone_number TEXT NOT NULL,  -- ДОЛЖНО БЫТЬ phone_number, НЕ phone!
-                total_price REAL NOT NULL,
-                status TEXT DEFAULT 'processing',
-                date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                message_id INTEGER
-            )
-        """)
-        
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS favorites (
-                user_id INTEGER NOT NULL,
-                product_id INTEGER NOT NULL,
-                PRIMARY KEY (user_id, product_id),
-                FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
-            )
-        """)
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+from cache import ProductCache
+from migrations import migrate
+from orders import INITIAL_STATUS, SOURCES
+from monitoring import add_db_time
+
+DB_PATH = "shop.db"
+
+# Полная строка товара в том виде, в каком она хранится в ProductCache
+PRODUCT_COLUMNS = "id, name, description, price, discount_price, quantity, image, image_file_id"
+
+# Строка заказа для истории: дата хранится в UTC и сразу переводится в московское время (UTC+3)
+ORDER_PAGE_COLUMNS = "id, strftime('%d.%m.%Y %H:%M', date, '+3 hours'), total_price, status"
+
+# Сколько параметров передавать в один запрос IN (...); старые сборки SQLite принимают не больше 999
+MAX_SQL_PARAMS = 500
+
+# Сколько секунд товар в корзине зарезервирован за покупателем после последнего изменения
+RESERVATION_TTL = 15 * 60
+
+# Остаток товара p.id, доступный покупателю :user_id: склад минус живые резервы других покупателей
+AVAILABLE_QUANTITY = """
+    p.quantity - (
+        SELECT COALESCE(SUM(r.quantity), 0) FROM reservations r
+        WHERE r.product_id = p.id AND r.user_id != :user_id AND r.expires_at > :now
+    )
+"""
+
+
+def search_terms(text, max_terms=8):
+    """Разбивает поисковый запрос на слова в нижнем регистре без спецсимволов FTS5"""
+    return re.findall(r"\w+", text.lower())[:max_terms]
+
+
+class OutOfStockError(Exception):
+    """Заказ отклонен: части товаров из корзины нет на складе в нужном количестве"""
+
+    def __init__(self, products):
+        super().__init__(", ".join(products))
+        self.products = products
+
+
+class ConnectionPool:
+    """Пул соединений SQLite: одно соединение на запись и несколько только для чтения.
+
+    WAL позволяет читателям работать параллельно с записью, поэтому каталог
+    отдается даже тогда, когда идет оформление заказа."""
+
+    PRAGMAS = (
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA cache_size = -16000",      # 16 МБ страничного кэша на соединение
+        "PRAGMA mmap_size = 268435456",    # 256 МБ отображаемого в память файла
+        "PRAGMA foreign_keys = ON",
+        "PRAGMA temp_store = MEMORY",
+    )
+
+    def __init__(self, path=DB_PATH, readers=4, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._write_lock = threading.Lock()
+        self.transactions = 0
+        self.lock_waits = 0
+        self.lock_wait_seconds = 0.0
+        self._writer = self._connect(path)
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect(f"file:{path}?mode=ro", uri=True))
+
+    def _connect(self, database, uri=False):
+        conn = sqlite3.connect(
+            database, timeout=self.timeout, uri=uri,
+            isolation_level=None, check_same_thread=False
+        )
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """Выдает соединение на запись внутри транзакции: COMMIT при успехе, ROLLBACK при ошибке"""
+        if not self._write_lock.acquire(blocking=False):
+            started = time.perf_counter()
+            self._write_lock.acquire()
+            self.lock_waits += 1
+            self.lock_wait_seconds += time.perf_counter() - started
+        try:
+            self.transactions += 1
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+        finally:
+            self._write_lock.release()
+
+    @contextmanager
+    def reader(self):
+        """Выдает свободное соединение только для чтения"""
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def stats(self):
+        """Число транзакций записи и ожиданий блокировки писателя"""
+        return {
+            "write_transactions": self.transactions,
+            "lock_waits": self.lock_waits,
+            "lock_wait_seconds": self.lock_wait_seconds,
+        }
 
-        self.conn.commit()
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
 
 
-    def add_product(self, name, description, price, discount_price, quantity, image):
-        """Добавляет новый товар в БД"""
-        self.cursor.execute("""
-            INSERT INTO products (name, description, price, discount_price, quantity, image) 
-            VALUES (?, ?, ?, ?, ?, ?)
-            """, (name, description, price, discount_price, quantity, image))
-        self.conn.commit()
+class Database:
+    def __init__(self, path=DB_PATH, readers=4, cache_size=5000):
+        self.pool = ConnectionPool(path, readers=readers)
+        self.cache = ProductCache(max_products=cache_size)
+        migrate(self.pool)
+        self._watch_interval = None
+        self._watch_checked = 0.0
+        self._watch_seen = None
+        self._watch_lock = threading.Lock()
+
+    def watch_catalog(self, interval=1.0):
+        """Включает сверку кэша с правками других процессов, работающих с той же БД.
+
+        Не чаще раза в interval секунд перед чтением из кэша и в фоновой задаче
+        процесса сверяются счетчики catalog_state: правка товаров сбрасывает кэш целиком, изменение остатков -
+        только строки товаров с количеством."""
+        self._watch_interval = interval
+
+    def _sync_catalog(self):
+        if self._watch_interval is None:
+            return
+        now = time.monotonic()
+        if now - self._watch_checked < self._watch_interval or not self._watch_lock.acquire(blocking=False):
+            return
+        try:
+            self._watch_checked = now
+            with self.pool.reader() as conn:
+                seen = self._catalog_state(conn)
+            previous, self._watch_seen = self._watch_seen, seen
+            if previous is None or previous == seen:
+                return
+            if previous[0] != seen[0]:
+                self.cache.invalidate()
+            else:
+                self.cache.drop_stock()
+        finally:
+            self._watch_lock.release()
+
+    def _catalog_state(self, conn):
+        return conn.execute("SELECT version, stock_version FROM catalog_state").fetchone()
+
+    def _own_catalog_write(self, before, after):
+        """Учитывает счетчики catalog_state после записи этого процесса, чтобы сверка не
+        сбрасывала из-за нее кэш; правки соседей, не сверенные до записи, она все равно найдет"""
+        with self._watch_lock:
+            if self._watch_seen == before:
+                self._watch_seen = after
+
+    def _cached_product(self, product_id):
+        """Возвращает полную строку товара из кэша, при промахе читает ее из БД"""
+        self._sync_catalog()
+        row = self.cache.get(product_id)
+        if row is None:
+            generation = self.cache.generation()
+            with self.pool.reader() as conn:
+                row = conn.execute(
+                    f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id = ?", (product_id,)
+                ).fetchone()
+            if row is not None:
+                self.cache.put(row, generation)
+        return row
+
+    def _cached_products(self, product_ids):
+        """Возвращает {id: строка товара}: найденное в кэше плюс один запрос IN (...) на промахи"""
+        self._sync_catalog()
+        rows = {}
+        missing = []
+        for product_id in dict.fromkeys(product_ids):
+            row = self.cache.get(product_id)
+            if row is None:
+                missing.append(product_id)
+            else:
+                rows[product_id] = row
+
+        if missing:
+            generation = self.cache.generation()
+            with self.pool.reader() as conn:
+                for start in range(0, len(missing), MAX_SQL_PARAMS):
+                    chunk = missing[start:start + MAX_SQL_PARAMS]
+                    placeholders = ", ".join("?" * len(chunk))
+                    for row in conn.execute(
+                        f"SELECT {PRODUCT_COLUMNS} FROM products WHERE id IN ({placeholders})", chunk
+                    ):
+                        rows[row[0]] = row
+                        self.cache.put(row, generation)
+        return rows
+
+    def _cached_list(self, key, load):
+        """Возвращает список из кэша, при промахе вычисляет его через load(conn)"""
+        self._sync_catalog()
+        rows = self.cache.get_list(key)
+        if rows is None:
+            generation = self.cache.generation()
+            with self.pool.reader() as conn:
+                rows = load(conn)
+            self.cache.put_list(key, rows, generation)
+        return rows
+
+    def cache_stats(self):
+        """Счетчики попаданий и промахов кэша каталога"""
+        return self.cache.stats()
+
+    def pool_stats(self):
+        """Счетчики транзакций и ожиданий блокировки записи"""
+        return self.pool.stats()
+
+    def add_product(self, name, description, price, discount_price, quantity, image, image_file_id=None):
+        """Добавляет новый товар в БД.
+
+        image - ссылка на изображение, image_file_id - фото, загруженное прямо в Telegram."""
+        with self.pool.writer() as conn:
+            conn.execute("""
+                INSERT INTO products (name, description, price, discount_price, quantity, image, image_file_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (name, description, price, discount_price, quantity, image, image_file_id))
+        self.cache.invalidate()
+
+
+    def save_image_file_id(self, product_id, file_id, image):
+        """Запоминает file_id фото, отправленного по ссылке image.
+
+        Если ссылку успели поменять, file_id относится к старому изображению и не сохраняется."""
+        return bool(self.save_image_file_ids([(product_id, file_id, image)]))
+
+
+    def save_image_file_ids(self, items):
+        """То же для нескольких фото (например, медиагруппы) одной транзакцией.
+
+        items - тройки (product_id, file_id, image); возвращает id товаров, для которых file_id сохранен."""
+        saved = []
+        with self.pool.writer() as conn:
+            for product_id, file_id, image in items:
+                if conn.execute(
+                    "UPDATE products SET image_file_id = ? WHERE id = ? AND image IS ?", (file_id, product_id, image)
+                ).rowcount:
+                    saved.append((product_id, file_id))
+        for product_id, file_id in saved:
+            self.cache.patch_image_file_id(product_id, file_id)
+        return [product_id for product_id, _ in saved]
+
+
+    def forget_image_file_id(self, product_id, file_id):
+        """Сбрасывает file_id, который Telegram больше не принимает"""
+        with self.pool.writer() as conn:
+            conn.execute(
+                "UPDATE products SET image_file_id = NULL WHERE id = ? AND image_file_id = ?", (product_id, file_id)
+            )
+        self.cache.patch_image_file_id(product_id, None)
 
 
     def get_product_info(self, product_id):
         """Получает информацию о товаре по ID"""
-        self.cursor.execute("SELECT name, description, price, discount_price, quantity, image FROM products WHERE id = ?", (product_id,))
-        return self.cursor.fetchone()
+        row = self._cached_product(product_id)
+        return row[1:] if row else None
 
 
     def add_to_favorites(self, user_id, product_id):
-        """Добавляет товар в избранное пользователя."""
-        conn = sqlite3.connect("shop.db")
-        cursor = conn.cursor()
-
-
-        cursor.execute("""
-            INSERT INTO favorites (user_id, product_id) 
-            VALUES (?, ?)
-        """, (user_id, product_id))
-        
-        conn.commit()
+        """Добавляет товар в избранное пользователя; False, если товара уже нет."""
+        with self.pool.writer() as conn:
+            cursor = conn.execute("""
+                INSERT OR IGNORE INTO favorites (user_id, product_id)
+                SELECT ?, id FROM products WHERE id = ?
+            """, (user_id, product_id))
+            # Товар уже в избранном - строка не записана, но товар существует
+            return bool(cursor.rowcount) or conn.execute(
+                "SELECT 1 FROM favorites WHERE user_id = ? AND product_id = ?", (user_id, product_id)
+            ).fetchone() is not None
 
 
     def get_favorites_by_user(self, user_id):
         """Возвращает все избранные товары пользователя."""
-        conn = sqlite3.connect("shop.db")
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            SELECT p.id, p.name, p.price, p.discount_price 
-            FROM favorites f
-            JOIN products p ON f.product_id = p.id
-            WHERE f.user_id = ?
-        """, (user_id,))
-        
-        favorites = cursor.fetchall()
-        
-        return favorites
+        with self.pool.reader() as conn:
+            return conn.execute("""
+                SELECT p.id, p.name, p.price, p.discount_price
+                FROM favorites f
+                JOIN products p ON f.product_id = p.id
+                WHERE f.user_id = ?
+            """, (user_id,)).fetchall()
 
 
     def remove_favorite(self, user_id: int, product_id: int):
         """Удаляет товар из избранного пользователя, но НЕ удаляет сам товар из каталога."""
-        conn = sqlite3.connect("shop.db")
-        cursor = conn.cursor()
-
-        cursor.execute(
-            "DELETE FROM favorites WHERE user_id = ? AND product_id = ?",
-            (user_id, product_id),
-        )
-        conn.commit()
+        with self.pool.writer() as conn:
+            conn.execute(
+                "DELETE FROM favorites WHERE user_id = ? AND product_id = ?",
+                (user_id, product_id),
+            )
 
 
     def get_products_sorted_by_discount(self):
         """Возвращает товары, отсортированные по размеру скидки (от максимальной к минимальной)."""
-        self.cursor.execute("""
+        return self._cached_list("discount", lambda conn: conn.execute("""
             SELECT id, name, price, discount_price, image
             FROM products
             WHERE discount_price < price
             ORDER BY (price - discount_price) DESC
-        """)
-        return self.cursor.fetchall()
+        """).fetchall())
 
 
     def get_product_info_by_id(self, product_id):
         """Возвращает информацию о товарах"""
-        query = "SELECT name, price, discount_price FROM products WHERE id = ?"
-        self.cursor.execute(query, (product_id,))
-        result = self.cursor.fetchone()
-    
+        result = self._cached_product(product_id)
+
         if result:
             return {
-                "name": result[0],
-                "price": result[1],
-                "discount_price": result[2] if result[2] is not None else result[1]  
+                "name": result[1],
+                "price": result[3],
+                "discount_price": result[4] if result[4] is not None else result[3]
             }
         return None
 
 
+    def get_products_by_ids(self, product_ids):
+        """Возвращает строки товаров (id, name, description, price, discount_price, quantity, image,
+        image_file_id) в порядке product_ids; несуществующие товары пропускаются"""
+        rows = self._cached_products(product_ids)
+        return [rows[product_id] for product_id in dict.fromkeys(product_ids) if product_id in rows]
+
+
     def save_order_message_id(self, order_id, message_id):
         """Сохраняет ID сообщения заказа в группе."""
-        self.cursor.execute("UPDATE orders SET message_id = ? WHERE id = ?", (message_id, order_id))
-        self.conn.commit()
+        with self.pool.writer() as conn:
+            conn.execute("UPDATE orders SET message_id = ? WHERE id = ?", (message_id, order_id))
 
 
     def get_order_message_id(self, order_id):
         """Получает ID сообщения заказа в группе."""
-        self.cursor.execute("SELECT message_id FROM orders WHERE id = ?", (order_id,))
-        result = self.cursor.fetchone()
+        with self.pool.reader() as conn:
+            result = conn.execute("SELECT message_id FROM orders WHERE id = ?", (order_id,)).fetchone()
         return result[0] if result else None
 
 
-    def add_phone_number_column(self):
-        """Добавляет колонку phone_number, если ее нет"""
-        try:
-            self.cursor.execute("ALTER TABLE orders ADD COLUMN phone_number TEXT")
-            self.conn.commit()
-        except sqlite3.OperationalError:
-            pass  
-
-
     def get_product_quantity(self, product_id):
         """Возвращает количество товара в наличии"""
-        self.cursor.execute("SELECT quantity FROM products WHERE id = ?", (product_id,))
-        result = self.cursor.fetchone()
+        with self.pool.reader() as conn:
+            result = conn.execute("SELECT quantity FROM products WHERE id = ?", (product_id,)).fetchone()
         return result[0] if result else 0
 
 
-    def reduce_product_quantity(self, product_id, quantity):
-        """Уменьшает количество товара в наличии"""
-        self.cursor.execute(
-            "UPDATE products SET quantity = quantity - ? WHERE id = ? AND quantity >= ?",
-            (quantity, product_id, quantity)
-        )
-        self.conn.commit()
-
-
     def get_cart_quantity(self, user_id, product_id):
         """Возвращает количество товара в корзине у пользователя"""
-        self.cursor.execute(
-            "SELECT quantity FROM cart WHERE user_id = ? AND product_id = ?", (user_id, product_id)
-        )
-        result = self.cursor.fetchone()
+        with self.pool.reader() as conn:
+            result = conn.execute(
+                "SELECT quantity FROM cart WHERE user_id = ? AND product_id = ?", (user_id, product_id)
+            ).fetchone()
         return result[0] if result else 0
 
 
     def add_to_cart(self, user_id, product_id, quantity):
-        """Добавляет товар в корзину, если общее количество не превышает доступное"""
-        available_quantity = self.get_product_quantity(product_id)
-        current_cart_quantity = self.get_cart_quantity(user_id, product_id)
-
-        if current_cart_quantity + quantity > available_quantity:
-            return False  
-
-        self.cursor.execute(
-            "INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, ?) "
-            "ON CONFLICT(user_id, product_id) DO UPDATE SET quantity = quantity + ?",
-            (user_id, product_id, quantity, quantity)
-        )
-        self.conn.commit()
-        return True
+        """Добавляет товар в корзину и резервирует его, если общее количество не превышает доступное.
+
+        Доступно то, что есть на складе и не зарезервировано другими покупателями.
+        Проверка, UPSERT и резерв выполняются одной транзакцией, поэтому одновременные
+        нажатия не могут разобрать больше, чем есть на складе. Возвращает новое
+        количество товара в корзине или None, если товара не хватает."""
+        now = time.time()
+        with self.pool.writer() as conn:
+            row = conn.execute(f"""
+                INSERT INTO cart (user_id, product_id, quantity)
+                SELECT :user_id, p.id, :quantity
+                FROM products p
+                LEFT JOIN cart c ON c.user_id = :user_id AND c.product_id = p.id
+                WHERE p.id = :product_id AND COALESCE(c.quantity, 0) + :quantity <= {AVAILABLE_QUANTITY}
+                ON CONFLICT(user_id, product_id) DO UPDATE SET quantity = cart.quantity + excluded.quantity
+                RETURNING quantity
+            """, {"user_id": user_id, "product_id": product_id, "quantity": quantity, "now": now}).fetchone()
+            if row:
+                self._reserve(conn, user_id, product_id, row[0], now)
+        return row[0] if row else None
+
+
+    def _reserve(self, conn, user_id, product_id, quantity, now):
+        """Резервирует quantity единиц товара за покупателем на RESERVATION_TTL секунд"""
+        if quantity > 0:
+            conn.execute("""
+                INSERT INTO reservations (user_id, product_id, quantity, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id, product_id) DO UPDATE SET
+                    quantity = excluded.quantity, expires_at = excluded.expires_at
+            """, (user_id, product_id, quantity, now + RESERVATION_TTL))
+        else:
+            conn.execute("DELETE FROM reservations WHERE user_id = ? AND product_id = ?", (user_id, product_id))
+
+
+    def expire_reservations(self, batch=500):
+        """Удаляет истекшие резервы пачками по batch строк, каждая - своей короткой транзакцией.
+
+        На доступный остаток истекшие резервы и так не влияют: очистка только не дает
+        таблице расти. Возвращает число удаленных резервов."""
+        now = time.time()
+        deleted = 0
+        while True:
+            with self.pool.writer() as conn:
+                count = conn.execute("""
+                    DELETE FROM reservations WHERE rowid IN (
+                        SELECT rowid FROM reservations WHERE expires_at <= ? LIMIT ?
+                    )
+                """, (now, batch)).rowcount
+            deleted += count
+            if count < batch:
+                return deleted
 
 
     def get_product_by_id(self, product_id):
         """ Получает товар по его ID. """
-        self.cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-        return self.cursor.fetchone()
-    
+        with self.pool.reader() as conn:
+            return conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
+
 
 
     def delete_product(self, product_id):
         """ Удаляет товар из базы данных по его ID. """
-        self.cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
-        self.conn.commit()
+        with self.pool.writer() as conn:
+            conn.execute("DELETE FROM cart WHERE product_id = ?", (product_id,))
+            conn.execute("DELETE FROM products WHERE id = ?", (product_id,))
+        self.cache.invalidate(product_id)
 
 
     def get_product(self):
         """Получает информацию о товарах"""
-        self.cursor.execute("SELECT id, name, price, discount_price FROM products") 
-        return self.cursor.fetchall()
+        return self._cached_list("products", lambda conn: conn.execute(
+            "SELECT id, name, price, discount_price FROM products"
+        ).fetchall())
+
+
+    def upsert_products(self, rows):
+        """Добавляет или обновляет товары одной транзакцией, сопоставляя их по названию.
+
+        rows - список (name, description, price, discount_price, quantity, image); если название
+        встречается дважды, побеждает последняя строка. Возвращает (добавлено, обновлено)."""
+        products = {}
+        for row in rows:
+            products[row[0]] = row
+        if not products:
+            return 0, 0
+
+        with self.pool.writer() as conn:
+            names = list(products)
+            existing = set()
+            for start in range(0, len(names), MAX_SQL_PARAMS):
+                chunk = names[start:start + MAX_SQL_PARAMS]
+                placeholders = ", ".join("?" * len(chunk))
+                existing.update(name for name, in conn.execute(
+                    f"SELECT name FROM products WHERE name IN ({placeholders})", chunk
+                ))
+            conn.executemany("""
+                UPDATE products SET description = ?, price = ?, discount_price = ?, quantity = ?, image = ?
+                WHERE name = ?
+            """, [row[1:] + row[:1] for name, row in products.items() if name in existing])
+            conn.executemany("""
+                INSERT INTO products (name, description, price, discount_price, quantity, image)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [row for name, row in products.items() if name not in existing])
+        self.cache.invalidate()
+        # Повтор названия внутри пачки считается обновлением
+        inserted = len(products) - len(existing)
+        return inserted, len(rows) - inserted
+
+
+    def iter_products(self, chunk_size=500):
+        """Все товары (name, description, price, discount_price, quantity, image) порциями по
+        chunk_size: каждая порция - отдельный keyset-запрос, весь каталог в память не читается"""
+        cursor = 0
+        while True:
+            with self.pool.reader() as conn:
+                rows = conn.execute("""
+                    SELECT id, name, description, price, discount_price, quantity, image FROM products
+                    WHERE id > ? ORDER BY id LIMIT ?
+                """, (cursor, chunk_size)).fetchall()
+            if not rows:
+                return
+            cursor = rows[-1][0]
+            yield [row[1:] for row in rows]
+
+
+    def get_catalog_page(self, cursor=0, limit=5, backward=False):
+        """Возвращает страницу каталога (keyset-пагинация по id) и признаки наличия соседних страниц.
+
+        cursor - id последнего товара предыдущей страницы (или первого товара
+        следующей, если backward=True)."""
+        def load(conn):
+            if backward:
+                rows = conn.execute(
+                    "SELECT id, name, price, discount_price FROM products WHERE id < ? ORDER BY id DESC LIMIT ?",
+                    (cursor, limit + 1)
+                ).fetchall()
+                has_prev = len(rows) > limit
+                return rows[:limit][::-1], has_prev, True
+
+            rows = conn.execute(
+                "SELECT id, name, price, discount_price FROM products WHERE id > ? ORDER BY id LIMIT ?",
+                (cursor, limit + 1)
+            ).fetchall()
+            has_prev = bool(rows) and conn.execute(
+                "SELECT EXISTS (SELECT 1 FROM products WHERE id < ?)", (rows[0][0],)
+            ).fetchone()[0] == 1
+            return rows[:limit], has_prev, len(rows) > limit
+
+        return self._cached_list(("page", cursor, limit, backward), load)
+
+
+    def get_gallery_page(self, cursor=0, limit=10):
+        """Следующая порция товаров с фото после id cursor и признак, что есть еще.
+
+        Строки (id, name, price, discount_price, image, image_file_id) читаются по limit
+        штук keyset-запросом, а не всем каталогом. Они не кэшируются: file_id товара
+        может появиться после первой отправки без смены версии каталога."""
+        with self.pool.reader() as conn:
+            rows = conn.execute("""
+                SELECT id, name, price, discount_price, image, image_file_id FROM products
+                WHERE id > ? AND (image_file_id IS NOT NULL OR image LIKE 'http%')
+                ORDER BY id LIMIT ?
+            """, (cursor, limit + 1)).fetchall()
+        return rows[:limit], len(rows) > limit
+
+
+    def search_products(self, query, offset=0, limit=5):
+        """Ищет товары по названию и описанию (FTS5, ранжирование bm25, поиск по началу слова).
+
+        Возвращает страницу результатов и признак наличия следующей страницы."""
+        terms = search_terms(query)
+        if not terms:
+            return [], False
+
+        match = " ".join(f'"{term}"*' for term in terms)
+        with self.pool.reader() as conn:
+            rows = conn.execute("""
+                SELECT p.id, p.name, p.price, p.discount_price
+                FROM products_fts
+                JOIN products p ON p.id = products_fts.rowid
+                WHERE products_fts MATCH ?
+                ORDER BY bm25(products_fts, 10.0, 1.0)
+                LIMIT ? OFFSET ?
+            """, (match, limit + 1, offset)).fetchall()
+        return rows[:limit], len(rows) > limit
 
 
     def get_product_by_name(self, name):
         """Получает информацию о товаре по его имени"""
-        self.cursor.execute("SELECT * FROM products WHERE name = ?", (name,))
-        return self.cursor.fetchone()
+        with self.pool.reader() as conn:
+            return conn.execute("SELECT * FROM products WHERE name = ?", (name,)).fetchone()
 
 
     def delete_product_by_name(self, name):
         """Удаляет товар по его имени"""
-        self.cursor.execute("DELETE FROM products WHERE name = ?", (name,))
-        self.conn.commit()
+        with self.pool.writer() as conn:
+            conn.execute("DELETE FROM cart WHERE product_id IN (SELECT id FROM products WHERE name = ?)", (name,))
+            conn.execute("DELETE FROM products WHERE name = ?", (name,))
+        self.cache.invalidate()
 
 
     def get_product_details(self, product_id):
         """Получает подробную информацию  о товаре"""
-        with closing(self.conn.cursor()) as cursor:
-            cursor.execute("SELECT name, description, price, discount_price, image FROM products WHERE id = ?", (product_id,))
-            return cursor.fetchone()
+        row = self._cached_product(product_id)
+        return row[1:5] + row[6:] if row else None
 
 
     def show_cart(self, user_id):
         """Возвращает список товаров в корзине пользователя"""
-        self.cursor.execute("""
-            SELECT p.id, p.name, p.discount_price, c.quantity
-            FROM cart c
-            JOIN products p ON c.product_id = p.id
-            WHERE c.user_id = ?
-        """, (user_id,))
-    
-        return self.cursor.fetchall()
+        with self.pool.reader() as conn:
+            return conn.execute("""
+                SELECT p.id, p.name, p.discount_price, c.quantity
+                FROM cart c
+                JOIN products p ON c.product_id = p.id
+                WHERE c.user_id = ?
+            """, (user_id,)).fetchall()
 
 
     def get_orders_by_user(self, user_id):
-        """Возвращает все товара пользователя"""
-        self.cursor.execute(
-            "SELECT id, date, total_price, status FROM orders WHERE user_id = ?", (user_id,)
-        )
-        result = self.cursor.fetchall()
-        print("Результат запроса:", result) 
-        return result
-
-
-    def update_order_status(self, order_id, new_status):
-        """Обновляет статус заказа"""
-        self.cursor.execute("UPDATE orders SET status = ? WHERE id = ?", (new_status, order_id))
-        self.conn.commit()
+        """Возвращает все заказы пользователя"""
+        with self.pool.reader() as conn:
+            return conn.execute(
+                "SELECT id, date, total_price, status FROM orders WHERE user_id = ?", (user_id,)
+            ).fetchall()
+
+
+    def get_orders_page(self, user_id, cursor=0, limit=5, backward=False):
+        """Возвращает (заказы новыми сверху, есть ли предыдущая страница, есть ли следующая) после заказа cursor"""
+        with self.pool.reader() as conn:
+            if backward:
+                rows = conn.execute(f"""
+                    SELECT {ORDER_PAGE_COLUMNS} FROM orders
+                    WHERE user_id = ? AND (date, id) > (SELECT date, id FROM orders WHERE id = ?)
+                    ORDER BY date, id LIMIT ?
+                """, (user_id, cursor, limit + 1)).fetchall()
+                return rows[:limit][::-1], len(rows) > limit, True
+
+            if cursor:
+                rows = conn.execute(f"""
+                    SELECT {ORDER_PAGE_COLUMNS} FROM orders
+                    WHERE user_id = ? AND (date, id) < (SELECT date, id FROM orders WHERE id = ?)
+                    ORDER BY date DESC, id DESC LIMIT ?
+                """, (user_id, cursor, limit + 1)).fetchall()
+            else:
+                rows = conn.execute(f"""
+                    SELECT {ORDER_PAGE_COLUMNS} FROM orders
+                    WHERE user_id = ?
+                    ORDER BY date DESC, id DESC LIMIT ?
+                """, (user_id, limit + 1)).fetchall()
+        return rows[:limit], bool(cursor) and bool(rows), len(rows) > limit
+
+
+    def get_order_details(self, order_id, user_id):
+        """Возвращает заказ пользователя и его состав: ((id, дата по Москве, сумма, статус),
+        [(name, quantity, price), ...]) или None, если заказа нет или он принадлежит другому"""
+        with self.pool.reader() as conn:
+            order = conn.execute(
+                f"SELECT {ORDER_PAGE_COLUMNS} FROM orders WHERE id = ? AND user_id = ?", (order_id, user_id)
+            ).fetchone()
+            if order is None:
+                return None
+            items = conn.execute(
+                "SELECT name, quantity, price FROM order_items WHERE order_id = ? ORDER BY rowid", (order_id,)
+            ).fetchall()
+        return order, items
+
+
+    def transition_order(self, order_id, status, changed_by=None):
+        """Переводит заказ в статус status: (order, message_id, items) или None, если переход недоступен"""
+        sources = SOURCES.get(status)
+        if not sources:
+            return None
+        placeholders = ", ".join("?" * len(sources))
+        with self.pool.writer() as conn:
+            row = conn.execute(f"""
+                UPDATE orders SET status = ? WHERE id = ? AND status IN ({placeholders})
+                RETURNING id, user_id, customer_name, phone_number, total_price, status, message_id
+            """, (status, order_id, *sources)).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "INSERT INTO order_status_history (order_id, status, changed_by) VALUES (?, ?, ?)",
+                (order_id, status, changed_by)
+            )
+            items = conn.execute(
+                "SELECT name, quantity FROM order_items WHERE order_id = ? ORDER BY rowid", (order_id,)
+            ).fetchall()
+        return row[:6], row[6], items
 
 
-    def get_user_by_order(self, order_id):
-        """Получает user_id по номеру заказа"""
-        self.cursor.execute("SELECT user_id FROM orders WHERE id = ?", (order_id,))
-        result = self.cursor.fetchone()
-        return result[0] if result else None
+    def get_order_status_history(self, order_id):
+        """История статусов заказа: (status, changed_by, changed_at) от старых к новым"""
+        with self.pool.reader() as conn:
+            return conn.execute("""
+                SELECT status, changed_by, changed_at FROM order_status_history
+                WHERE order_id = ? ORDER BY changed_at, id
+            """, (order_id,)).fetchall()
 
 
     def increase_cart_item(self, user_id, product_id):
-        """ Увеличивает количество товара в корзине, если хватает на складе """
-        available_quantity = self.get_product_quantity(product_id)
-        current_cart_quantity = self.get_cart_quantity(user_id, product_id)
-
-        if current_cart_quantity < available_quantity:
-            self.cursor.execute(
-            "UPDATE cart SET quantity = quantity + 1 WHERE user_id = ? AND product_id = ?",
-            (user_id, product_id)
-            )
-            self.conn.commit()
-            return True
-        return False  
+        """ Увеличивает количество товара в корзине и резерв, если хватает доступного остатка.
+        Возвращает новое количество или None """
+        now = time.time()
+        with self.pool.writer() as conn:
+            row = conn.execute(f"""
+                UPDATE cart SET quantity = quantity + 1
+                WHERE user_id = :user_id AND product_id = :product_id
+                  AND quantity < (SELECT {AVAILABLE_QUANTITY} FROM products p WHERE p.id = cart.product_id)
+                RETURNING quantity
+            """, {"user_id": user_id, "product_id": product_id, "now": now}).fetchone()
+            if row:
+                self._reserve(conn, user_id, product_id, row[0], now)
+        return row[0] if row else None
 
 
     def decrease_cart_item(self, user_id, product_id):
-        """ Уменьшает количество товара в корзине, удаляя товар, если он становится 0 """
-        self.cursor.execute(
-            "UPDATE cart SET quantity = quantity - 1 WHERE user_id = ? AND product_id = ? AND quantity > 1",
-            (user_id, product_id)
-        )
-        self.cursor.execute("DELETE FROM cart WHERE user_id = ? AND product_id = ? AND quantity = 0", (user_id, product_id))
-        self.conn.commit()
+        """ Уменьшает количество товара в корзине, удаляя товар, если он становится 0.
+        Возвращает оставшееся количество """
+        with self.pool.writer() as conn:
+            row = conn.execute(
+                "UPDATE cart SET quantity = quantity - 1 WHERE user_id = ? AND product_id = ? RETURNING quantity",
+                (user_id, product_id)
+            ).fetchone()
+            if row and row[0] <= 0:
+                conn.execute("DELETE FROM cart WHERE user_id = ? AND product_id = ?", (user_id, product_id))
+            if row:
+                self._reserve(conn, user_id, product_id, row[0], time.time())
+        return max(row[0], 0) if row else 0
 
 
     def remove_from_cart(self, user_id, product_id):
-        """ Удаляет товар из корзины """
-        self.cursor.execute("DELETE FROM cart WHERE user_id = ? AND product_id = ?", (user_id, product_id))
-        self.conn.commit()
-
-
-    def update_stock(self, product_id, quantity_sold):
-        """Обновляет количество товара после оформления заказа"""
-        self.cursor.execute("UPDATE products SET quantity = quantity - ? WHERE id = ?", (quantity_sold, product_id))
-        self.conn.commit()
+        """ Удаляет товар из корзины и снимает его резерв """
+        with self.pool.writer() as conn:
+            conn.execute("DELETE FROM cart WHERE user_id = ? AND product_id = ?", (user_id, product_id))
+            conn.execute("DELETE FROM reservations WHERE user_id = ? AND product_id = ?", (user_id, product_id))
 
 
     def clear_cart(self, user_id):
-        """Очищает корзину пользователя"""
-        self.cursor.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
-        self.conn.commit()
+        """Очищает корзину пользователя и снимает его резервы"""
+        with self.pool.writer() as conn:
+            conn.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM reservations WHERE user_id = ?", (user_id,))
 
 
     def create_order(self, user_id, phone_number, total_price, message_id):
         """Создает заказ и сохраняет его в базе."""
-        self.cursor.execute(
-            "INSERT INTO orders (user_id, phone_number, total_price, status, message_id) VALUES (?, ?, ?, 'pending', ?)",
-            (user_id, phone_number, total_price, message_id)
-        )
-        self.conn.commit()
-        return self.cursor.lastrowid 
+        with self.pool.writer() as conn:
+            order_id = conn.execute(
+                "INSERT INTO orders (user_id, phone_number, total_price, status, message_id) VALUES (?, ?, ?, ?, ?)",
+                (user_id, phone_number, total_price, INITIAL_STATUS, message_id)
+            ).lastrowid
+            conn.execute(
+                "INSERT INTO order_status_history (order_id, status, changed_by) VALUES (?, ?, ?)",
+                (order_id, INITIAL_STATUS, user_id)
+            )
+        return order_id
 
 
     def add_order_item(self, order_id, product_id, quantity, price):
         """Сохраняет товары в заказе"""
-        self.cursor.execute(
-            "INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, ?, ?)",
-            (order_id, product_id, quantity, price)
-        )
-        self.conn.commit()
+        with self.pool.writer() as conn:
+            conn.execute(
+                "INSERT INTO order_items (order_id, product_id, name, quantity, price) "
+                "SELECT ?, id, name, ?, ? FROM products WHERE id = ?",
+                (order_id, quantity, price, product_id)
+            )
+
+
+    def place_order(self, user_id, phone_number, customer_name=None):
+        """Оформляет заказ из корзины: (order_id, items, total_price), None при пустой корзине, OutOfStockError при нехватке"""
+        with self.pool.writer() as conn:
+            before = self._catalog_state(conn)
+            cart = conn.execute(f"""
+                SELECT p.id, p.name, COALESCE(p.discount_price, p.price), c.quantity, {AVAILABLE_QUANTITY}
+                FROM cart c
+                JOIN products p ON c.product_id = p.id
+                WHERE c.user_id = :user_id
+            """, {"user_id": user_id, "now": time.time()}).fetchall()
+
+            if not cart:
+                return None
+
+            short = [name for _, name, _, quantity, stock in cart if quantity > stock]
+            if short:
+                raise OutOfStockError(short)
+
+            items = [(product_id, name, price, quantity) for product_id, name, price, quantity, _ in cart]
+            total_price = sum(price * quantity for _, _, price, quantity in items)
+
+            order_id = conn.execute(
+                "INSERT INTO orders (user_id, customer_name, phone_number, total_price, status) VALUES (?, ?, ?, ?, ?)",
+                (user_id, customer_name, phone_number, total_price, INITIAL_STATUS)
+            ).lastrowid
+            conn.execute(
+                "INSERT INTO order_status_history (order_id, status, changed_by) VALUES (?, ?, ?)",
+                (order_id, INITIAL_STATUS, user_id)
+            )
+            conn.executemany(
+                "INSERT INTO order_items (order_id, product_id, name, quantity, price) VALUES (?, ?, ?, ?, ?)",
+                [(order_id, product_id, name, quantity, price) for product_id, name, price, quantity in items]
+            )
+            conn.execute("""
+                UPDATE products
+                SET quantity = quantity - (
+                    SELECT c.quantity FROM cart c WHERE c.user_id = ? AND c.product_id = products.id
+                )
+                WHERE id IN (SELECT product_id FROM cart WHERE user_id = ?)
+            """, (user_id, user_id))
+            conn.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM reservations WHERE user_id = ?", (user_id,))
+            after = self._catalog_state(conn)
+
+        # Остатки в кэше уже поправлены на месте - сбрасывать их при сверке не нужно
+        for product_id, _, _, quantity in items:
+            self.cache.patch_quantity(product_id, quantity)
+        self._own_catalog_write(before, after)
+        return order_id, items, total_price
 
 
     def get_order_by_id(self, order_id):
         """Получает информацию о заказе по его ID"""
-        self.cursor.execute("SELECT id, user_id, phone, total_price, status FROM orders WHERE id = ?", (order_id,))
-        return self.cursor.fetchone()
+        with self.pool.reader() as conn:
+            return conn.execute(
+                "SELECT id, user_id, phone_number, total_price, status FROM orders WHERE id = ?", (order_id,)
+            ).fetchone()
 
 
     def get_all_products_with_stock(self):
         """Получает все товары и их количество"""
-        query = "SELECT name, quantity FROM products"  
-        self.cursor.execute(query)
-        return self.cursor.fetchall()
+        query = "SELECT id, name, quantity FROM products"
+        return self._cached_list("stock", lambda conn: conn.execute(query).fetchall())
+
+
+    def get_fsm_session(self, key):
+        """(state, data, updated_at) сохраненной сессии FSM или None"""
+        with self.pool.reader() as conn:
+            return conn.execute(
+                "SELECT state, data, updated_at FROM fsm_sessions WHERE key = ?", (key,)
+            ).fetchone()
+
+
+    def save_fsm_sessions(self, saved, deleted, expire_before=None):
+        """Сохраняет пачку сессий FSM одной транзакцией.
+
+        saved - (key, state, data, updated_at), deleted - (key,) завершенных сессий;
+        если задан expire_before, удаляет и сессии, не менявшиеся с этого момента."""
+        with self.pool.writer() as conn:
+            conn.executemany("""
+                INSERT INTO fsm_sessions (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+            """, saved)
+            conn.executemany("DELETE FROM fsm_sessions WHERE key = ?", deleted)
+            if expire_before is not None:
+                conn.execute("DELETE FROM fsm_sessions WHERE updated_at < ?", (expire_before,))
 
 
     def close(self):
-        self.conn.close()
+        self.pool.close()
+
+
+class AsyncDatabase:
+    """Асинхронный аналог Database: запросы выполняются в ограниченном пуле потоков,
+    поэтому event loop не блокируется на SQLite."""
+
+    def __init__(self, path=DB_PATH, readers=4):
+        self.db = Database(path, readers=readers)
+        # Читатели работают параллельно, писатель один - больше потоков не нужно
+        self._executor = ThreadPoolExecutor(max_workers=readers + 1, thread_name_prefix="db")
+
+    @property
+    def catalog_version(self):
+        """Версия каталога: меняется при любой правке товаров.
+
+        Правки других процессов учитываются фоновой сверкой (sync_catalog в add.py):
+        здесь запросов к БД нет, свойство читается в цикле событий."""
+        return self.db.cache.version
+
+    async def run(self, name, *args, **kwargs):
+        """Выполняет метод Database с указанным именем в пуле потоков"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, partial(getattr(self.db, name), *args, **kwargs))
+        finally:
+            add_db_time(time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        if name.startswith("_") or not callable(getattr(Database, name, None)):
+            raise AttributeError(name)
+
+        async def method(*args, **kwargs):
+            return await self.run(name, *args, **kwargs)
+
+        method.__name__ = name
+        method.__doc__ = getattr(Database, name).__doc__
+        setattr(self, name, method)
+        return method
+
+    async def close(self):
+        """Дожидается выполнения запросов и закрывает пул соединений"""
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+        self.db.close()
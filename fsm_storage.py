@@ -0,0 +1,121 @@
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в таблице fsm_sessions базы магазина.
+
+    Чтение идет из LRU в памяти, при промахе - из БД. Запись сразу меняет LRU, а в
+    БД попадает пачкой раз в flush_interval секунд (write-behind): незавершенные
+    сценарии добавления товара и оформления заказа переживают перезапуск бота,
+    а при аварийном падении теряются изменения только за последний интервал.
+    Сессии, которых не касались ttl секунд, считаются брошенными и удаляются.
+
+    В многопроцессном режиме обновления одного пользователя всегда обрабатывает
+    один процесс, поэтому LRU разных процессов не пересекаются."""
+
+    def __init__(self, db, ttl=7 * 24 * 3600, max_cached=10000, flush_interval=0.5, sweep_interval=600):
+        self.db = db
+        self.ttl = ttl
+        self.max_cached = max_cached
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._flusher = None
+        self._swept_at = time.time()
+
+    async def _session(self, key):
+        """(state, data, updated_at) из LRU или БД; брошенная сессия считается пустой"""
+        name = self.key_builder.build(key)
+        # Несохраненная сессия могла уже уйти из LRU, но в _dirty она есть всегда
+        session = self._dirty.get(name) or self._cache.get(name)
+        if session is None:
+            row = await self.db.get_fsm_session(name)
+            session = (row[0], json.loads(row[1]), row[2]) if row else (None, {}, 0.0)
+            # Пока шел запрос, сессию могли изменить
+            session = self._dirty.get(name) or self._cache.get(name) or session
+        self._remember(name, session)
+        if session[2] and session[2] < time.time() - self.ttl:
+            return None, {}, 0.0
+        return session
+
+    def _remember(self, name, session):
+        self._cache[name] = session
+        self._cache.move_to_end(name)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def _store(self, key, state, data):
+        name = self.key_builder.build(key)
+        session = (state, data, time.time())
+        self._remember(name, session)
+        self._dirty[name] = session
+        if self._flusher is None or self._flusher.done():
+            # Фоновая запись не должна наследовать контекст обновления, которое ее запустило
+            self._flusher = contextvars.Context().run(asyncio.create_task, self._flush_loop())
+
+    async def set_state(self, key, state=None):
+        _, data, _ = await self._session(key)
+        self._store(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key):
+        return (await self._session(key))[0]
+
+    async def set_data(self, key, data):
+        state, _, _ = await self._session(key)
+        self._store(key, state, dict(data))
+
+    async def get_data(self, key):
+        return dict((await self._session(key))[1])
+
+    async def _flush_loop(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Не удалось сохранить состояния FSM")
+
+    async def flush(self):
+        """Записывает накопленные изменения одной транзакцией и удаляет брошенные сессии"""
+        dirty, self._dirty = self._dirty, {}
+        saved, deleted = [], []
+        for name, (state, data, updated_at) in dirty.items():
+            if state is None and not data:
+                deleted.append((name,))
+            else:
+                saved.append((name, state, json.dumps(data, ensure_ascii=False), updated_at))
+
+        now = time.time()
+        expire_before = None
+        if now - self._swept_at >= self.sweep_interval:
+            self._swept_at = now
+            expire_before = now - self.ttl
+            for name in [name for name, session in self._cache.items() if session[2] < expire_before]:
+                del self._cache[name]
+
+        if saved or deleted or expire_before:
+            try:
+                await self.db.save_fsm_sessions(saved, deleted, expire_before)
+            except Exception:
+                # Вернуть несохраненное в очередь, не затирая более свежие изменения
+                self._dirty = {**dirty, **self._dirty}
+                raise
+        for name, session in dirty.items():
+            if session[0] is None and not session[1] and self._cache.get(name) is session:
+                del self._cache[name]
+
+    async def close(self):
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        if self._dirty:
+            await self.flush()
@@ -0,0 +1,335 @@
+import logging
+
+
+# Миграции схемы БД. Каждая применяется ровно один раз в своей транзакции, номер
+# примененной миграции записывается в schema_version. Новые изменения схемы
+# добавляются в конец MIGRATIONS со следующим номером; старые миграции не меняются.
+
+
+def create_base_tables(conn):
+    """Таблицы товаров, корзины, заказов и избранного"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            description TEXT,
+            price REAL,
+            discount_price REAL,
+            quantity INTEGER,
+            image TEXT
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cart (
+            user_id INTEGER,
+            product_id INTEGER,
+            quantity INTEGER,
+            PRIMARY KEY (user_id, product_id),
+            FOREIGN KEY (product_id) REFERENCES products (id)
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            phone_number TEXT NOT NULL,
+            total_price REAL NOT NULL,
+            status TEXT DEFAULT 'processing',
+            date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            message_id INTEGER
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS favorites (
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, product_id),
+            FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+        )
+    """)
+
+
+def add_phone_number_column(conn):
+    """Колонка phone_number в базах, созданных до ее появления"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(orders)")}
+    if "phone_number" not in columns:
+        conn.execute("ALTER TABLE orders ADD COLUMN phone_number TEXT")
+
+
+def create_order_items(conn):
+    """Состав заказа хранится снимком: название и цена на момент покупки"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+            order_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            price REAL NOT NULL,
+            PRIMARY KEY (order_id, product_id),
+            FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE
+        )
+    """)
+
+
+def create_products_fts(conn):
+    """Полнотекстовый индекс по названию и описанию.
+
+    products остается источником данных, триггеры поддерживают индекс в
+    актуальном состоянии."""
+    fts_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'"
+    ).fetchone()
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, description,
+            content = 'products', content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+            INSERT INTO products_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+    """)
+    if not fts_exists:
+        conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+
+def create_lookup_indexes(conn):
+    """Индексы для заказов пользователя, поиска товара по имени и списка скидок.
+
+    Избранное и корзина уже индексированы первичным ключом (user_id, product_id)."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_date ON orders (user_id, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_name ON products (name)")
+    # Частичный индекс по выражению: только товары со скидкой, сразу в порядке ее размера
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_products_discount ON products ((price - discount_price) DESC)
+        WHERE discount_price < price
+    """)
+
+
+def create_catalog_state(conn):
+    """Счетчики изменений каталога и остатков для процессов, у которых свой кэш каталога.
+
+    version растет при правке товаров, stock_version - при изменении остатков."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0,
+            stock_version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO catalog_state (id) VALUES (1)")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS catalog_state_insert AFTER INSERT ON products BEGIN
+            UPDATE catalog_state SET version = version + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS catalog_state_delete AFTER DELETE ON products BEGIN
+            UPDATE catalog_state SET version = version + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS catalog_state_update
+        AFTER UPDATE OF name, description, price, discount_price, image ON products BEGIN
+            UPDATE catalog_state SET version = version + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS catalog_state_stock AFTER UPDATE OF quantity ON products BEGIN
+            UPDATE catalog_state SET stock_version = stock_version + 1;
+        END
+    """)
+
+
+def create_fsm_sessions(conn):
+    """Состояния FSM пользователей: сценарии не обрываются при перезапуске бота"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_sessions (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_sessions_updated ON fsm_sessions (updated_at)")
+
+
+def add_image_file_id_column(conn):
+    """file_id фото товара, полученный от Telegram при первой отправке.
+
+    При смене ссылки на изображение сохраненный file_id сбрасывается."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(products)")}
+    if "image_file_id" not in columns:
+        conn.execute("ALTER TABLE products ADD COLUMN image_file_id TEXT")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_image_changed AFTER UPDATE OF image ON products
+        WHEN old.image IS NOT new.image BEGIN
+            UPDATE products SET image_file_id = NULL WHERE id = new.id;
+        END
+    """)
+
+
+def create_reservations(conn):
+    """Резервы товаров из корзин: пока срок резерва не истек, эти единицы не может
+    положить в корзину или купить другой покупатель"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS reservations (
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (user_id, product_id),
+            FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+        )
+    """)
+    # Покрывающий индекс: сумма живых резервов товара считается без чтения таблицы
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_reservations_product ON reservations (product_id, expires_at, quantity)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_expires ON reservations (expires_at)")
+
+
+def create_order_status_history(conn):
+    """Имя покупателя в заказе и история смены статусов.
+
+    Для существующих заказов история начинается с их текущего статуса."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(orders)")}
+    if "customer_name" not in columns:
+        conn.execute("ALTER TABLE orders ADD COLUMN customer_name TEXT")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS order_status_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            changed_by INTEGER,
+            changed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_order_status_history_order ON order_status_history (order_id, changed_at)"
+    )
+    conn.execute("""
+        INSERT INTO order_status_history (order_id, status, changed_at)
+        SELECT id, COALESCE(status, 'processing'), COALESCE(date, CURRENT_TIMESTAMP) FROM orders
+    """)
+
+
+# (версия, описание, функция)
+MIGRATIONS = (
+    (1, "Базовые таблицы", create_base_tables),
+    (2, "Колонка orders.phone_number", add_phone_number_column),
+    (3, "Таблица order_items", create_order_items),
+    (4, "Полнотекстовый индекс products_fts", create_products_fts),
+    (5, "Индексы заказов, имен товаров и скидок", create_lookup_indexes),
+    (6, "Счетчики изменений каталога", create_catalog_state),
+    (7, "Таблица fsm_sessions", create_fsm_sessions),
+    (8, "Колонка products.image_file_id", add_image_file_id_column),
+    (9, "Таблица reservations", create_reservations),
+    (10, "Имя покупателя и история статусов заказа", create_order_status_history),
+)
+
+
+def current_version(conn):
+    """Номер последней примененной миграции, 0 для пустой базы"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def migrate(pool):
+    """Применяет недостающие миграции; на актуальной базе выполняет один SELECT"""
+    with pool.writer() as conn:
+        version = current_version(conn)
+
+    for number, description, apply in MIGRATIONS:
+        if number <= version:
+            continue
+        with pool.writer() as conn:
+            # Несколько процессов могут запускаться одновременно: миграцию применяет первый
+            if current_version(conn) >= number:
+                continue
+            apply(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)", (number, description)
+            )
+        logging.info("Миграция %d применена: %s", number, description)
+
+
+# Горячие запросы и индекс, которым каждый из них обязан пользоваться
+HOT_QUERIES = {
+    "get_orders_by_user": (
+        "SELECT id, date, total_price, status FROM orders WHERE user_id = ?", (0,), "idx_orders_user_date"
+    ),
+    # Страницы истории заказов (get_orders_page): первая, следующая и предыдущая
+    "orders_page_first": (
+        "SELECT id, date, total_price, status FROM orders WHERE user_id = ? ORDER BY date DESC, id DESC LIMIT ?",
+        (0, 6), "idx_orders_user_date"
+    ),
+    "orders_page_next": (
+        "SELECT id, date, total_price, status FROM orders WHERE user_id = ? "
+        "AND (date, id) < (SELECT date, id FROM orders WHERE id = ?) ORDER BY date DESC, id DESC LIMIT ?",
+        (0, 0, 6), "idx_orders_user_date"
+    ),
+    "orders_page_previous": (
+        "SELECT id, date, total_price, status FROM orders WHERE user_id = ? "
+        "AND (date, id) > (SELECT date, id FROM orders WHERE id = ?) ORDER BY date, id LIMIT ?",
+        (0, 0, 6), "idx_orders_user_date"
+    ),
+    "get_product_by_name": (
+        "SELECT * FROM products WHERE name = ?", ("",), "idx_products_name"
+    ),
+    "get_favorites_by_user": (
+        "SELECT p.id FROM favorites f JOIN products p ON f.product_id = p.id WHERE f.user_id = ?",
+        (0,), "sqlite_autoindex_favorites_1"
+    ),
+    "get_products_sorted_by_discount": (
+        "SELECT id FROM products WHERE discount_price < price ORDER BY (price - discount_price) DESC",
+        (), "idx_products_discount"
+    ),
+    "reserved_by_others": (
+        "SELECT COALESCE(SUM(quantity), 0) FROM reservations WHERE product_id = ? AND user_id != ? AND expires_at > ?",
+        (0, 0, 0), "idx_reservations_product"
+    ),
+}
+
+
+def explain_query_plan(conn, sql, params=()):
+    """Строки плана EXPLAIN QUERY PLAN для запроса"""
+    # EXPLAIN не сверяет версию схемы: обычный запрос заставляет соединение
+    # перечитать схему, если ее изменило другое соединение
+    conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def check_query_plans(conn):
+    """Возвращает {запрос: план} для горячих запросов, которые не используют свой индекс"""
+    problems = {}
+    for name, (sql, params, index) in HOT_QUERIES.items():
+        plan = explain_query_plan(conn, sql, params)
+        if not any(index in step for step in plan):
+            problems[name] = plan
+    return problems
@@ -0,0 +1,240 @@
+import bisect
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+# Границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Timings:
+    """Замеры одного обновления: какой обработчик его обработал и сколько времени ушло на БД и Bot API"""
+
+    __slots__ = ("handler", "db", "api")
+
+    def __init__(self):
+        self.handler = None
+        self.db = 0.0
+        self.api = 0.0
+
+
+current_timings = ContextVar("current_timings", default=None)
+
+
+def label_handler(name):
+    """Подписывает текущее обновление именем обработчика"""
+    timings = current_timings.get()
+    if timings is not None:
+        timings.handler = name
+
+
+def add_db_time(seconds):
+    timings = current_timings.get()
+    if timings is not None:
+        timings.db += seconds
+
+
+def add_api_time(seconds):
+    timings = current_timings.get()
+    if timings is not None:
+        timings.api += seconds
+
+
+class Histogram:
+    """Накопительная гистограмма в формате Prometheus"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        cumulative += self.counts[-1]
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {cumulative}"
+
+
+class HandlerStats:
+    __slots__ = ("requests", "errors", "total", "db", "api")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total = Histogram()
+        self.db = Histogram()
+        self.api = Histogram()
+
+
+class Metrics:
+    """Счетчики и гистограммы по обработчикам плюс показатели, которые снимаются при выгрузке.
+
+    Источники показателей (gauges) - функции без аргументов, возвращающие словарь
+    {имя: число}, например SendScheduler.stats или ProductCache.stats."""
+
+    def __init__(self):
+        self._handlers = {}
+        self._gauges = []
+        self._lock = threading.Lock()
+
+    def observe(self, handler, total, db, api, error=False):
+        with self._lock:
+            stats = self._handlers.get(handler)
+            if stats is None:
+                stats = self._handlers[handler] = HandlerStats()
+            stats.requests += 1
+            stats.errors += error
+            stats.total.observe(total)
+            stats.db.observe(db)
+            stats.api.observe(api)
+
+    def add_gauges(self, prefix, source):
+        """Регистрирует источник показателей, которые выгружаются как bot_<prefix>_<имя>"""
+        self._gauges.append((prefix, source))
+
+    def render(self):
+        """Текст для Prometheus (text exposition format 0.0.4)"""
+        lines = [
+            "# TYPE bot_handler_requests_total counter",
+            "# TYPE bot_handler_errors_total counter",
+            "# TYPE bot_handler_seconds histogram",
+            "# TYPE bot_handler_db_seconds histogram",
+            "# TYPE bot_handler_api_seconds histogram",
+        ]
+        with self._lock:
+            for handler, stats in sorted(self._handlers.items()):
+                labels = f'handler="{handler}"'
+                lines.append(f"bot_handler_requests_total{{{labels}}} {stats.requests}")
+                lines.append(f"bot_handler_errors_total{{{labels}}} {stats.errors}")
+                lines.extend(stats.total.lines("bot_handler_seconds", labels))
+                lines.extend(stats.db.lines("bot_handler_db_seconds", labels))
+                lines.extend(stats.api.lines("bot_handler_api_seconds", labels))
+
+        for prefix, source in self._gauges:
+            for name, value in source().items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"# TYPE bot_{prefix}_{name} gauge")
+                    lines.append(f"bot_{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Внешний middleware обновлений: время обработки, ошибки, доли БД и Bot API по обработчикам.
+
+    Регистрируется на dp.update.outer_middleware; имя обработчика проставляет
+    HandlerLabelMiddleware (или CallbackRouter для нажатий на кнопки)."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def __call__(self, handler, event, data):
+        timings = Timings()
+        token = current_timings.set(timings)
+        started = time.perf_counter()
+        error = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            error = True
+            raise
+        finally:
+            current_timings.reset(token)
+            self.metrics.observe(
+                timings.handler or f"unhandled_{event.event_type}",
+                time.perf_counter() - started, timings.db, timings.api, error
+            )
+
+
+class HandlerLabelMiddleware(BaseMiddleware):
+    """Внутренний middleware: сообщает MetricsMiddleware, какой обработчик выбран для события"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        if handler_object is not None:
+            label_handler(handler_object.callback.__name__)
+        return await handler(event, data)
+
+
+class ApiTimer(BaseRequestMiddleware):
+    """Middleware сессии бота: учитывает время запросов к Bot API в замерах текущего обновления.
+
+    Регистрируется после SendScheduler, чтобы ожидание в очереди отправки не
+    считалось временем API."""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            add_api_time(time.perf_counter() - started)
+
+
+def setup(dispatcher, metrics):
+    """Подключает замеры ко всем событиям диспетчера и вложенных роутеров"""
+    dispatcher.update.outer_middleware(MetricsMiddleware(metrics))
+    label = HandlerLabelMiddleware()
+    for name, observer in dispatcher.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(label)
+
+
+async def start_metrics_server(metrics, host="127.0.0.1", port=9108):
+    """Поднимает HTTP-эндпоинт /metrics; возвращает runner для остановки"""
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись лога; поля из extra попадают в запись как есть"""
+
+    RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in self.RESERVED})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level=logging.INFO):
+    """Структурированный лог без блокировок: обработчики только кладут записи в очередь,
+    в поток вывода их пишет отдельный поток. Возвращает listener для остановки."""
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+    listener.start()
+    return listener
@@ -0,0 +1,22 @@
+# Жизненный цикл заказа. Переходы объявлены только здесь: по ним строится
+# панель администратора, и их же проверяет UPDATE при смене статуса.
+
+# Статус нового заказа
+INITIAL_STATUS = "pending"
+
+# Статус -> статусы, в которые администратор может перевести заказ из него
+TRANSITIONS = {
+    "pending": ("processing", "confirmed", "canceled"),
+    "processing": ("confirmed", "canceled"),
+    "confirmed": ("shipped", "canceled"),
+    "shipped": ("completed", "failed"),
+    "completed": (),
+    "canceled": (),
+    "failed": (),
+}
+
+# Статус -> статусы, из которых в него можно перейти
+SOURCES = {
+    status: tuple(source for source, targets in TRANSITIONS.items() if status in targets)
+    for status in TRANSITIONS
+}
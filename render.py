@@ -0,0 +1,352 @@
+import threading
+from collections import OrderedDict
+from html import escape
+from typing import NamedTuple, Optional
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.utils.markdown import hbold
+
+from callbacks import (
+    AddFavorite, AddToCart, CatalogPage, GalleryPage, OrderDetails, OrdersPage, OrderStatus, ProductDetails,
+    RemoveFavorite, SearchPage, ViewProduct
+)
+from orders import TRANSITIONS
+
+
+# Подписи статусов заказа
+ORDER_STATUSES = {
+    "processing": "📦 В обработке",
+    "confirmed": "✅ Подтвержден",
+    "shipped": "🚚 В пути",
+    "canceled": "🛑 Отменен",
+    "completed": "🎉 Завершен",
+    "failed": "❌ Неудача",
+    "pending": "⏳ Ожидает",
+}
+
+
+class Card(NamedTuple):
+    """Готовое к отправке представление: текст, клавиатура и изображение.
+
+    image - file_id фото в Telegram, если он уже известен, иначе ссылка; image_url -
+    ссылка, по которой фото можно отправить заново, если file_id не примут."""
+    text: str
+    markup: Optional[InlineKeyboardMarkup] = None
+    image: Optional[str] = None
+    image_url: Optional[str] = None
+
+
+class RenderCache:
+    """Кэш отрисованных карточек по ключу (товар или страница, вид, версия каталога).
+
+    Версия каталога меняется при любой правке товаров, поэтому устаревшие карточки
+    никогда не отдаются, а при смене версии кэш просто очищается."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._cards = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, kind, version):
+        with self._lock:
+            if version != self._version:
+                self._cards.clear()
+                self._version = version
+            card = self._cards.get((key, kind))
+            if card is None:
+                self.misses += 1
+                return None
+            self._cards.move_to_end((key, kind))
+            self.hits += 1
+            return card
+
+    def put(self, key, kind, version, card):
+        with self._lock:
+            if version == self._version:
+                self._cards[(key, kind)] = card
+                while len(self._cards) > self.max_size:
+                    self._cards.popitem(last=False)
+        return card
+
+    def discard(self, key):
+        """Убирает все карточки по ключу, не трогая версию каталога"""
+        with self._lock:
+            for cached in [cached for cached in self._cards if cached[0] == key]:
+                del self._cards[cached]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "cards": len(self._cards)}
+
+
+def discount_percent(price, discount_price):
+    """Размер скидки в процентах или None, если скидки нет"""
+    if discount_price is None or discount_price >= price:
+        return None
+    return round((1 - discount_price / price) * 100, 2)
+
+
+def product_images(image, file_id):
+    """(image, image_url) для Card из колонок image и image_file_id товара"""
+    url = image if image and image.startswith("http") else None
+    return file_id or url, url
+
+
+def price_text(price, discount_price):
+    """Строка цены для списков товаров"""
+    percent = discount_percent(price, discount_price)
+    if percent:
+        return f"🔥 <s>{price}₽</s> → <b>{discount_price}₽</b> (-{percent}%)"
+    return f"💰 Цена: <b>{price}₽</b>"
+
+
+def product_buttons(number, product_id):
+    """Кнопки купить / подробнее / в избранное для товара под номером number"""
+    return [
+        InlineKeyboardButton(text=f"🛒 {number}", callback_data=AddToCart(product_id=product_id).pack()),
+        InlineKeyboardButton(text=f"ℹ️ {number}", callback_data=ProductDetails(product_id=product_id).pack()),
+        InlineKeyboardButton(text=f"❤️ {number}", callback_data=AddFavorite(product_id=product_id).pack())
+    ]
+
+
+def render_product_list(title, products):
+    """Нумерованный список карточек (id, name, price, discount_price) и кнопки действий для каждой"""
+    text = f"{title}\n\n"
+    inline_kb = []
+
+    for number, (product_id, name, price, discount_price) in enumerate(products, start=1):
+        text += f"{number}. {hbold(name)}\n{price_text(price, discount_price)}\n\n"
+        inline_kb.append(product_buttons(number, product_id))
+
+    return text, inline_kb
+
+
+def render_catalog_page(products, has_prev, has_next):
+    """Страница каталога: карточки товаров и клавиатура с навигацией"""
+    text, inline_kb = render_product_list("🛍 <b>Каталог</b>", products)
+
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(text="◀", callback_data=CatalogPage(cursor=products[0][0], backward=True).pack()))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="▶", callback_data=CatalogPage(cursor=products[-1][0]).pack()))
+    if navigation:
+        inline_kb.append(navigation)
+    inline_kb.append([InlineKeyboardButton(text="🖼 Галерея", callback_data=GalleryPage(cursor=0).pack())])
+
+    return Card(text, InlineKeyboardMarkup(inline_keyboard=inline_kb))
+
+
+def render_gallery_page(products, has_next):
+    """Страница галереи из строк get_gallery_page.
+
+    Возвращает (items, keyboard): items - пары (product_id, Card) с подписью и фото
+    для одной медиагруппы, keyboard - одно сообщение с кнопками всех товаров
+    страницы (у медиагруппы своей клавиатуры быть не может)."""
+    items = []
+    inline_kb = []
+    for number, (product_id, name, price, discount_price, image, file_id) in enumerate(products, start=1):
+        caption = f"{number}. {hbold(name)}\n{price_text(price, discount_price)}"
+        items.append((product_id, Card(caption, None, *product_images(image, file_id))))
+        inline_kb.append(product_buttons(number, product_id))
+
+    if has_next:
+        inline_kb.append([InlineKeyboardButton(text="▶ Еще", callback_data=GalleryPage(cursor=products[-1][0]).pack())])
+
+    keyboard = Card("🖼 <b>Галерея</b>: выберите товар по номеру", InlineKeyboardMarkup(inline_keyboard=inline_kb))
+    return items, keyboard
+
+
+def render_search_results(query, products, offset, page_size, has_next):
+    """Страница результатов поиска с навигацией по страницам"""
+    text, inline_kb = render_product_list(f"🔎 Результаты поиска: {hbold(query)}", products)
+
+    navigation = []
+    if offset > 0:
+        navigation.append(InlineKeyboardButton(
+            text="◀", callback_data=SearchPage(offset=max(offset - page_size, 0), query=query).pack()
+        ))
+    if has_next:
+        navigation.append(InlineKeyboardButton(
+            text="▶", callback_data=SearchPage(offset=offset + page_size, query=query).pack()
+        ))
+    if navigation:
+        inline_kb.append(navigation)
+
+    return Card(text, InlineKeyboardMarkup(inline_keyboard=inline_kb))
+
+
+def render_product_details(product_id, product):
+    """Карточка "ℹ️ Подробнее" из строки get_product_details"""
+    name, description, price, discount_price, image, file_id = product
+
+    text = f"📌 {hbold(name)}\n\n📄 {description}\n\n"
+    percent = discount_percent(price, discount_price)
+    if percent:
+        text += f"🔥 <s>{price}₽</s> ➝ {discount_price}₽ (-{percent}%)\n"
+    else:
+        text += f"💰 {price}₽\n"
+
+    return Card(text, None, *product_images(image, file_id))
+
+
+def render_favorite_product(product_id, product):
+    """Карточка товара, открытого из избранного или спецпредложений"""
+    name, description, price, discount_price, image, file_id = product
+
+    text = f"📌 {hbold(name)}\n\n📄 {description}\n💰 Цена: {price}₽"
+    percent = discount_percent(price, discount_price)
+    if percent:
+        text += f"\n🔥 <s>{price}₽</s> → <b>{discount_price}₽</b> (-{percent}%)"
+
+    buttons = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="🛒 Купить", callback_data=AddToCart(product_id=product_id).pack())]
+        ]
+    )
+    return Card(text, buttons, *product_images(image, file_id))
+
+
+def render_special_offers(products):
+    """Список товаров со скидкой, отсортированный по ее размеру"""
+    text = "🔥 <b>Специальные предложения:</b>\n\n"
+    buttons = []
+
+    for product_id, name, price, discount_price, image in products:
+        percent = discount_percent(price, discount_price)
+
+        text += f"🛍️ {hbold(name)}\n"
+        if percent:
+            text += f"💰 <s>{price}₽</s> → <b>{discount_price}₽</b> (-{percent}%)\n\n"
+        else:
+            text += f"💰 {price}₽\n\n"
+
+        buttons.append([
+            InlineKeyboardButton(text=f"🔍 {name}", callback_data=ViewProduct(product_id=product_id).pack()),
+            InlineKeyboardButton(text="🛒 В корзину", callback_data=AddToCart(product_id=product_id).pack())
+        ])
+
+    return Card(text, InlineKeyboardMarkup(inline_keyboard=buttons))
+
+
+def render_favorites(products):
+    """Список избранного из строк (id, name, price, discount_price) с кнопками просмотра и удаления"""
+    text = "❤️ <b>Ваши избранные товары:</b>\n\n"
+    buttons = []
+
+    for product_id, name, price, discount_price in products:
+        percent = discount_percent(price, discount_price)
+        if percent:
+            text += f"🛍️ {hbold(name)}\n🔥 <s>{price}₽</s> → <b>{discount_price}₽</b> (-{percent}%)\n\n"
+        else:
+            text += f"🛍️ {hbold(name)} - {price}₽\n"
+
+        buttons.append([
+            InlineKeyboardButton(text=f"🔍 {name}", callback_data=ViewProduct(product_id=product_id).pack()),
+            InlineKeyboardButton(text="❌ Удалить", callback_data=RemoveFavorite(product_id=product_id).pack())
+        ])
+
+    return Card(text, InlineKeyboardMarkup(inline_keyboard=buttons))
+
+
+def order_status_label(status):
+    return ORDER_STATUSES.get(status, "Неизвестный статус")
+
+
+def render_orders_page(orders, has_prev, has_next):
+    """Страница истории заказов из строк (id, дата, сумма, статус) с навигацией"""
+    text = "📦 <b>Ваши заказы:</b>\n\n"
+    buttons = []
+
+    for order_id, date, total_price, status in orders:
+        text += (
+            f"🆔 <b>Заказ #{order_id}</b>\n📅 Дата: {date}\n💰 Сумма: {total_price}₽\n"
+            f"📦 Статус: <b>{order_status_label(status)}</b>\n\n"
+        )
+        buttons.append([
+            InlineKeyboardButton(text=f"🔍 Заказ #{order_id}", callback_data=OrderDetails(order_id=order_id).pack())
+        ])
+
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(text="◀", callback_data=OrdersPage(cursor=orders[0][0], backward=True).pack()))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="▶", callback_data=OrdersPage(cursor=orders[-1][0]).pack()))
+    if navigation:
+        buttons.append(navigation)
+
+    return Card(text, InlineKeyboardMarkup(inline_keyboard=buttons))
+
+
+def render_order_details(order, items):
+    """Состав заказа из order_items"""
+    order_id, date, total_price, status = order
+
+    text = f"🆔 <b>Заказ #{order_id}</b>\n📅 Дата: {date}\n📦 Статус: <b>{order_status_label(status)}</b>\n\n"
+    for name, quantity, price in items:
+        text += f"▫️ {hbold(name)} - {quantity} шт. × {price}₽\n"
+    text += f"\n💰 Итого: <b>{total_price}₽</b>"
+
+    buttons = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="◀ К заказам", callback_data=OrdersPage(cursor=0).pack())]
+        ]
+    )
+    return Card(text, buttons)
+
+
+def render_order_message(order, items, previous_text=None):
+    """Сообщение о заказе в группе администраторов и панель смены статуса.
+
+    Собирается из данных заказа; кнопки - только переходы, разрешенные из текущего
+    статуса (у завершенного заказа кнопок нет). У старых заказов нет позиций или
+    имени покупателя в БД - для них сохраняется текст прежнего сообщения previous_text,
+    меняется только строка статуса."""
+    order_id, user_id, customer_name, phone_number, total_price, status = order
+
+    if previous_text and (not items or customer_name is None):
+        # В message.text разметка уже снята, поэтому строка статуса ищется без звездочек
+        text = escape(previous_text.split("\n📦 Статус:")[0]) + "\n"
+    else:
+        text = f"🆕 <b>Заказ #{order_id}</b> от {escape(customer_name or 'покупателя')} (ID: {user_id})\n"
+        text += f"📞 Телефон: {escape(phone_number or '')}\n"
+        text += "".join(f"{escape(name)} - {quantity} шт.\n" for name, quantity in items)
+        text += f"💰 <b>Итого:</b> {total_price}₽\n"
+    text += f"📦 <b>Статус:</b> {order_status_label(status)}"
+
+    buttons = [
+        [InlineKeyboardButton(
+            text=order_status_label(target), callback_data=OrderStatus(order_id=order_id, status=target).pack()
+        )]
+        for target in TRANSITIONS.get(status, ())
+    ]
+    return Card(text, InlineKeyboardMarkup(inline_keyboard=buttons))
+
+
+def render_import_report(report):
+    """Итог /import_products: сколько товаров добавлено, обновлено и отклонено и почему"""
+    text = (
+        f"✅ Импорт завершен\n\n"
+        f"➕ Добавлено: {report.inserted}\n"
+        f"🔄 Обновлено: {report.updated}\n"
+        f"❌ Отклонено: {report.rejected}"
+    )
+    if report.errors:
+        text += "\n\n" + "\n".join(f"Строка {number}: {error}" for number, error in report.errors)
+        if report.rejected > len(report.errors):
+            text += f"\n… и еще {report.rejected - len(report.errors)}"
+    if report.stopped:
+        text += f"\n\n⚠️ Файл прочитан не до конца: {report.stopped}"
+    return text
+
+
+
+# Отрисовка карточки товара по виду
+PRODUCT_RENDERERS = {
+    "details": render_product_details,
+    "favorite": render_favorite_product,
+}
+
@@ -0,0 +1,182 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage, EditMessageCaption, EditMessageMedia, EditMessageReplyMarkup, EditMessageText,
+    ForwardMessage, SendDocument, SendMediaGroup, SendMessage, SendPhoto, SendSticker
+)
+
+# Методы, на которые Telegram накладывает лимиты отправки сообщений
+THROTTLED_METHODS = (
+    SendMessage, SendPhoto, SendSticker, SendDocument, SendMediaGroup, CopyMessage, ForwardMessage,
+    EditMessageText, EditMessageReplyMarkup, EditMessageCaption, EditMessageMedia,
+)
+
+# Приоритеты очереди: чем меньше число, тем раньше уходит сообщение
+PRIORITY_USER = 0
+PRIORITY_BULK = 1
+
+send_priority = ContextVar("send_priority", default=PRIORITY_USER)
+
+
+@contextmanager
+def bulk():
+    """Помечает отправки внутри блока как фоновые: они пропускают вперед ответы пользователям"""
+    token = send_priority.set(PRIORITY_BULK)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+def create_session(limit=100, keepalive_timeout=60):
+    """HTTP-сессия Bot API с пулом keep-alive соединений, общим для всех запросов"""
+    session = AiohttpSession(limit=limit)
+    session._connector_init["keepalive_timeout"] = keepalive_timeout
+    return session
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self):
+        """Забирает токен и возвращает, сколько секунд нужно подождать перед отправкой"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds):
+        """Запрещает отправку на seconds секунд (ответ 429 с retry_after)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self, now):
+        return self.tokens >= self.capacity and now - self.updated > 60
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """Планировщик исходящих сообщений для сессии бота.
+
+    Каждое сообщение сначала ждет свое место в ведре чата (1 сообщение в секунду
+    в личном чате, 20 в минуту в группе), затем - в общей очереди с приоритетами,
+    которая выдает не больше ~30 сообщений в секунду. Ответ 429 не пробрасывается
+    наружу: чат блокируется на retry_after, и отправка повторяется."""
+
+    def __init__(self, global_rate=30, private_rate=1.0, group_rate=20 / 60, burst=3, max_retries=3):
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._queue = []
+        self._sequence = itertools.count()
+        self._pump = None
+        self.waiting = 0
+        self.sent = 0
+        self.retries = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, THROTTLED_METHODS):
+            return await make_request(bot, method)
+
+        chat_id = self._chat_id(method)
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, send_priority.get())
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as error:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                bucket = self._global if chat_id is None else self._chat_bucket(chat_id)
+                bucket.block(error.retry_after)
+                continue
+            self.sent += 1
+            return response
+
+    @staticmethod
+    def _chat_id(method):
+        chat_id = getattr(method, "chat_id", None)
+        try:
+            return int(chat_id)
+        except (TypeError, ValueError):
+            return chat_id
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                now = time.monotonic()
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle(now)}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.private_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.burst)
+        return bucket
+
+    async def _acquire(self, chat_id, priority):
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            if chat_id is not None:
+                wait = self._chat_bucket(chat_id).reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+            ready = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._queue, (priority, next(self._sequence), ready))
+            if self._pump is None or self._pump.done():
+                self._pump = asyncio.create_task(self._run_pump())
+            await ready
+        finally:
+            self.waiting -= 1
+            waited = time.monotonic() - started
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    async def _run_pump(self):
+        """Выдает токены общего лимита ожидающим сообщениям в порядке приоритета"""
+        while self._queue:
+            wait = self._global.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            while self._queue:
+                _, _, ready = heapq.heappop(self._queue)
+                if not ready.done():
+                    ready.set_result(None)
+                    break
+
+    def share(self, workers):
+        """Делит общий лимит и лимит групп поровну между workers процессами, которые
+        отправляют сообщения от имени одного бота"""
+        self._global = TokenBucket(self._global.rate / workers, max(1.0, self._global.capacity / workers))
+        self.group_rate /= workers
+        self._chats = {}
+
+    def stats(self):
+        """Глубина очереди и время ожидания отправки"""
+        return {
+            "queue_depth": self.waiting,
+            "sent": self.sent,
+            "retries": self.retries,
+            "wait_seconds_total": self.wait_total,
+            "wait_seconds_max": self.wait_max,
+        }
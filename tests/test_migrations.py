@@ -0,0 +1,42 @@
+import sqlite3
+
+from database import ConnectionPool
+from migrations import MIGRATIONS, check_query_plans, current_version, migrate
+
+
+def test_migrate_creates_latest_schema(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "shop.db"))
+    migrate(pool)
+    migrate(pool)  # повторный запуск на актуальной базе ничего не меняет
+    with pool.writer() as conn:
+        assert current_version(conn) == len(MIGRATIONS)
+    pool.close()
+
+
+def test_hot_queries_use_their_indexes(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "shop.db"))
+    migrate(pool)
+    with pool.reader() as conn:
+        assert check_query_plans(conn) == {}
+    pool.close()
+
+
+def test_migrate_upgrades_legacy_database(tmp_path):
+    # База первой версии бота: таблицы без schema_version и без orders.phone_number
+    path = str(tmp_path / "shop.db")
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE products (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, description TEXT,
+            price REAL, discount_price REAL, quantity INTEGER, image TEXT);
+        CREATE TABLE orders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+            date DATETIME DEFAULT CURRENT_TIMESTAMP, total_price REAL, status TEXT, message_id INTEGER);
+        INSERT INTO orders (user_id, total_price, status) VALUES (1, 100, 'pending');
+    """)
+    conn.close()
+
+    pool = ConnectionPool(path)
+    migrate(pool)
+    with pool.reader() as conn:
+        assert check_query_plans(conn) == {}
+        assert conn.execute("SELECT COUNT(*) FROM order_status_history").fetchone() == (1,)
+    pool.close()
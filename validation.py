@@ -0,0 +1,64 @@
+# Правила для полей товара. Их используют и пошаговое добавление (/add_product),
+# и импорт каталога из файла; ValueError несет текст ошибки для пользователя.
+import math
+
+
+def parse_number(value):
+    """Число из строки или JSON; десятичная запятая тоже принимается"""
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError
+    if isinstance(value, str):
+        value = value.strip().replace(",", ".")
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError
+    return number
+
+
+def parse_name(value):
+    name = str(value).strip() if value is not None else ""
+    if not name:
+        raise ValueError("Название не может быть пустым.")
+    return name
+
+
+def parse_price(value):
+    try:
+        price = parse_number(value)
+    except ValueError:
+        price = 0
+    if price <= 0:
+        raise ValueError("Цена должна быть положительным числом.")
+    return price
+
+
+def parse_discount_price(value, price):
+    try:
+        discount_price = parse_number(value)
+    except ValueError:
+        raise ValueError("Скидочная цена должна быть числом.") from None
+    if discount_price >= price:
+        raise ValueError("Скидочная цена должна быть меньше основной.")
+    return discount_price
+
+
+def parse_quantity(value):
+    try:
+        if isinstance(value, (bool, float)):
+            raise ValueError
+        quantity = int(value)
+    except (TypeError, ValueError):
+        quantity = 0
+    if quantity < 1:
+        raise ValueError("Количество должно быть целым положительным числом.")
+    return quantity
+
+
+def parse_image(value):
+    """Ссылка на изображение или None"""
+    image = str(value).strip() if value is not None else ""
+    if not image or image.lower() == "без изображения":
+        return None
+    if not image.startswith("http"):
+        raise ValueError("Изображение должно быть ссылкой http(s).")
+    return image
@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+from urllib.parse import urlsplit
+
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+
+def default_secret(token):
+    """Секрет вебхука, одинаковый у всех экземпляров бота с этим токеном"""
+    return hashlib.sha256(f"webhook:{token}".encode()).hexdigest()
+
+
+def verify_secret(received, secret):
+    """Сравнивает заголовок X-Telegram-Bot-Api-Secret-Token с секретом за постоянное время"""
+    return hmac.compare_digest(received.encode(), secret.encode())
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Прием обновлений от Telegram: проверка секрета, мгновенный ответ 200 и обработка в фоне.
+
+    Одновременно диспетчер обрабатывает не больше concurrency обновлений, остальные
+    ждут в очереди. Если в очереди уже max_backlog обновлений, запрос отклоняется
+    с 503 - Telegram повторит его позже, а память процесса не растет без предела."""
+
+    def __init__(self, dispatcher, bot, secret_token, concurrency=64, max_backlog=1000, **data):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self.max_backlog = max_backlog
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def handle(self, request):
+        if len(self._background_feed_update_tasks) >= self.max_backlog:
+            return web.Response(status=503, text="Busy")
+        try:
+            return await super().handle(request)
+        except ValueError:
+            return web.Response(status=400, text="Bad update")
+
+    async def _background_feed_update(self, bot, update):
+        async with self._semaphore:
+            try:
+                await super()._background_feed_update(bot, update)
+            except Exception:
+                logging.exception("Ошибка обработки обновления из вебхука")
+
+    async def close(self):
+        """Дожидается обновлений, которые уже приняты, и закрывает сессию бота"""
+        if self._background_feed_update_tasks:
+            await asyncio.wait(set(self._background_feed_update_tasks))
+        await super().close()
+
+
+async def run_webhook(dispatcher, bot, url, secret, host="0.0.0.0", port=8080,
+                      concurrency=64, register=True, **data):
+    """Обслуживает вебхук до отмены задачи.
+
+    Путь берется из url. register=False пропускает setWebhook - так сервер можно
+    проверить локально, отправляя сохраненные обновления POST-запросами."""
+    path = urlsplit(url).path or "/"
+    app = web.Application()
+    BoundedRequestHandler(dispatcher, bot, secret, concurrency=concurrency, **data).register(app, path=path)
+    setup_application(app, dispatcher, bot=bot, **data)
+
+    if register:
+        await bot.set_webhook(
+            url, secret_token=secret, max_connections=min(concurrency, 100),
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("Вебхук слушает", extra={"host": host, "port": port, "path": path})
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
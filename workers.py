@@ -0,0 +1,207 @@
+"""Многопроцессный режим: фронт принимает обновления и раздает их K процессам-обработчикам.
+
+Обновления одного пользователя всегда попадают в один и тот же процесс и
+обрабатываются там строго по очереди, поэтому FSM (добавление товара,
+оформление заказа) и порядок действий с корзиной не зависят от числа процессов.
+Обновления chat_member рассылаются всем: у каждого процесса свой кэш
+администраторов. Процессы работают с одной базой SQLite в режиме WAL."""
+import asyncio
+import importlib
+import json
+import logging
+import multiprocessing
+import sys
+import threading
+
+from aiohttp import web
+
+from webhook import verify_secret
+
+# Поля обновления, в которых Telegram передает автора события
+USER_FIELDS = ("from", "user", "voter_chat")
+
+
+def partition_key(update):
+    """id пользователя, от которого пришло обновление, или None"""
+    for field, event in update.items():
+        if field == "update_id" or not isinstance(event, dict):
+            continue
+        for user_field in USER_FIELDS:
+            author = event.get(user_field)
+            if isinstance(author, dict) and "id" in author:
+                return author["id"]
+        chat = event.get("chat")
+        if isinstance(chat, dict):
+            return chat.get("id")
+    return None
+
+
+def is_broadcast(update):
+    """Обновление, которое нужно каждому процессу"""
+    return "chat_member" in update
+
+
+class Partitioner:
+    """Раскладывает сырые обновления по очередям процессов-обработчиков"""
+
+    def __init__(self, queues):
+        self.queues = queues
+        self.routed = [0] * len(queues)
+
+    def route(self, update):
+        payload = json.dumps(update, ensure_ascii=False)
+        if is_broadcast(update):
+            targets = range(len(self.queues))
+        else:
+            key = partition_key(update)
+            targets = (key % len(self.queues) if key is not None else 0,)
+        for index in targets:
+            self.queues[index].put(payload)
+            self.routed[index] += 1
+
+
+class UserSerializer:
+    """Выполняет корутины одного пользователя по очереди, разных пользователей - параллельно"""
+
+    def __init__(self):
+        self._tails = {}
+
+    async def run(self, key, make_coroutine):
+        previous = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+        try:
+            if previous is not None:
+                await previous
+            return await make_coroutine()
+        finally:
+            done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+
+async def consume(dispatcher, bot, updates, concurrency=64):
+    """Цикл процесса-обработчика: читает обновления из очереди и передает их диспетчеру.
+
+    Очередь multiprocessing читается в отдельном потоке; None в очереди означает,
+    что новых обновлений не будет. Возвращает (обработано, ошибок)."""
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue()
+
+    def read():
+        while True:
+            payload = updates.get()
+            loop.call_soon_threadsafe(inbox.put_nowait, payload)
+            if payload is None:
+                return
+
+    threading.Thread(target=read, name="updates-reader", daemon=True).start()
+
+    serializer = UserSerializer()
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+    counters = {"processed": 0, "errors": 0}
+
+    async def handle(update):
+        async with semaphore:
+            try:
+                await dispatcher.feed_raw_update(bot, update)
+            except Exception:
+                counters["errors"] += 1
+                logging.exception("Ошибка обработки обновления")
+            counters["processed"] += 1
+
+    while True:
+        payload = await inbox.get()
+        if payload is None:
+            break
+        update = json.loads(payload)
+        key = partition_key(update)
+        task = asyncio.create_task(serializer.run(key, lambda update=update: handle(update)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.wait(set(tasks))
+    return counters["processed"], counters["errors"]
+
+
+def worker_process(index, count, updates, results=None, session_factory=None):
+    """Точка входа процесса-обработчика (запускается через spawn).
+
+    Если фронт запущен как python add.py, spawn уже выполнил add.py в этом процессе
+    под именем __mp_main__; повторный import add создал бы второго бота и второй пул БД."""
+    main = sys.modules.get("__mp_main__")
+    add = main if hasattr(main, "run_worker") else importlib.import_module("add")
+
+    def ready():
+        if results is not None:
+            results.put(("ready", index))
+
+    processed, errors = asyncio.run(add.run_worker(index, count, updates, session_factory, ready))
+    if results is not None:
+        results.put(("done", index, processed, errors))
+
+
+def start_workers(count, results=None, session_factory=None):
+    """Запускает count процессов-обработчиков; возвращает (процессы, очереди)"""
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(count)]
+    processes = [
+        context.Process(
+            target=worker_process, args=(index, count, queues[index], results, session_factory),
+            name=f"shop-worker-{index}", daemon=True,
+        )
+        for index in range(count)
+    ]
+    for process in processes:
+        process.start()
+    return processes, queues
+
+
+def stop_workers(processes, queues, timeout=30):
+    """Просит процессы дообработать очереди и дожидается их завершения"""
+    for queue in queues:
+        queue.put(None)
+    for process in processes:
+        process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+
+
+async def poll(bot, partitioner, allowed_updates, timeout=30):
+    """Long polling во фронте: обновления не разбираются, а сразу раскладываются по процессам"""
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=allowed_updates)
+        except Exception:
+            logging.exception("Ошибка getUpdates")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            partitioner.route(update.model_dump(mode="json", exclude_none=True, by_alias=True))
+            offset = update.update_id + 1
+
+
+async def serve_webhook(partitioner, path, secret, host, port):
+    """Вебхук во фронте: проверка секрета, раскладка по процессам и мгновенный ответ"""
+    async def handle(request):
+        if not verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret):
+            return web.Response(status=401, text="Unauthorized")
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400, text="Bad update")
+        partitioner.route(update)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()